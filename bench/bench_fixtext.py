@@ -0,0 +1,94 @@
+"""
+Compare the old three-pass outgoingwh_fixtext() with the single-pass
+TextRewriter over a realistic mix of messages, and check that both give
+exactly the same output.
+
+    python3 bench/bench_fixtext.py [rounds]
+"""
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from slackbridge.rewrite import TextRewriter  # noqa
+from slackbridge.webapi import Channel, User  # noqa
+
+
+def old_fixtext(text, users_list, channels_list, atchannel):
+    def replace_channel(match):
+        channel_id = match.groups()[0]
+        try:
+            return '#' + channels_list[channel_id].name
+        except KeyError:
+            return '<#' + channel_id + '>'  # untouched
+
+    def replace_user(match):
+        user_id = match.groups()[0]
+        if '|' in user_id:
+            return '@' + user_id.split('|', 1)[1]
+        try:
+            return '@' + users_list[user_id].name
+        except KeyError:
+            return '<@' + user_id + '>'  # untouched
+
+    if atchannel:
+        text = re.sub(r'(^|[^\w])@' + atchannel + r'\b', r'\1@channel',
+                      text, flags=re.I)
+    text = re.sub(r'<@(U[^>]+)>', replace_user, text)
+    text = re.sub(r'<#(C[^>]+)>', replace_channel, text)
+    return text
+
+
+def messages(count, rnd):
+    words = ('ok', 'the', 'deploy', 'is', 'done', 'can', 'you', 'check',
+             'https://example.com/x?y=1', 'thanks!', ':+1:', 'log:', '42')
+    specials = ('<@U{:05d}>', '<@U{:05d}|walter>', '<#C{:04d}>', '@OtherCo',
+                '@othercompany', 'mail@othercompany.nl', '<#C{:04d}|chan>',
+                '&lt;@nobody&gt;', '<https://example.com|link>')
+    result = []
+    for i in range(count):
+        msg = [rnd.choice(words) for j in range(rnd.randint(1, 25))]
+        if rnd.random() < 0.6:  # most messages have no markup at all
+            for j in range(rnd.randint(1, 3)):
+                msg.insert(rnd.randint(0, len(msg)), rnd.choice(
+                    specials).format(rnd.randint(0, 2000)))
+        result.append(' '.join(msg))
+    return result
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    rnd = random.Random(1)
+    users = dict(('U{:05d}'.format(i), User(
+        'U{:05d}'.format(i), 'user{}'.format(i))) for i in range(1000))
+    channels = dict(('C{:04d}'.format(i), Channel(
+        'C{:04d}'.format(i), 'chan{}'.format(i))) for i in range(1000))
+    texts = messages(1000, rnd)
+
+    for text in texts:
+        old = old_fixtext(text, users, channels, 'othercompany')
+        new = TextRewriter.for_atchannel('othercompany').rewrite(
+            text, users, channels)
+        assert old == new, (text, old, new)
+
+    def run_old():
+        for text in texts:
+            old_fixtext(text, users, channels, 'othercompany')
+
+    def run_new():
+        for text in texts:
+            TextRewriter.for_atchannel('othercompany').rewrite(
+                text, users, channels)
+
+    t_old = min(timeit.repeat(run_old, number=rounds, repeat=3))
+    t_new = min(timeit.repeat(run_new, number=rounds, repeat=3))
+    per_msg = 1e6 / (rounds * len(texts))
+    print('three-pass  {:6.2f} us/message'.format(t_old * per_msg))
+    print('single-pass {:6.2f} us/message ({:.1f}x)'.format(
+        t_new * per_msg, t_old / t_new))
+
+
+if __name__ == '__main__':
+    main()
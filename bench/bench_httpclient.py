@@ -0,0 +1,91 @@
+"""
+Compare per-message latency of urllib's urlopen() against the pooled
+keep-alive ConnectionPool, using a local HTTPS stand-in for
+hooks.slack.com. Needs the openssl binary to create a throwaway
+certificate.
+
+    python3 bench/bench_httpclient.py [messages]
+"""
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import parse, request
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from slackbridge.httpclient import ConnectionPool  # noqa
+
+
+class IncomingWebhook(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+def make_cert(tmpdir):
+    cert = os.path.join(tmpdir, 'cert.pem')
+    key = os.path.join(tmpdir, 'key.pem')
+    subprocess.check_call([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+        '-days', '1', '-subj', '/CN=localhost', '-keyout', key,
+        '-out', cert], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+def run(label, post, count):
+    post()  # warm up
+    t0 = time.perf_counter()
+    for i in range(count):
+        post()
+    elapsed = time.perf_counter() - t0
+    print('{:<16} {:8.3f} ms/message'.format(label, elapsed * 1000 / count))
+    return elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cert, key = make_cert(tmpdir)
+        server = ThreadingHTTPServer(('localhost', 0), IncomingWebhook)
+        server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_ctx.load_cert_chain(cert, key)
+        server.socket = server_ctx.wrap_socket(
+            server.socket, server_side=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        client_ctx = ssl.create_default_context(cafile=cert)
+        url = 'https://localhost:{}/services/X/Y/Z'.format(
+            server.server_address[1])
+        data = parse.urlencode(
+            {'payload': '{"text": "hello", "channel": "#x"}'}).encode()
+
+        opener = request.build_opener(request.HTTPSHandler(
+            context=client_ctx))
+        plain = run('urllib', lambda: opener.open(url, data).read(), count)
+        pool = ConnectionPool(context=client_ctx)
+        pooled = run('ConnectionPool', lambda: pool.urlopen(url, data), count)
+        print('saved {:.3f} ms/message ({:.1f}x)'.format(
+            (plain - pooled) * 1000 / count, plain / pooled))
+        server.shutdown()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
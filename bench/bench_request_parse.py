@@ -0,0 +1,75 @@
+"""
+Parse a typical outgoing webhook POST body: the old cgi.FieldStorage
+path against slackbridge.body.parse_body().
+
+    python3 bench/bench_request_parse.py [rounds]
+
+(The cgi module is gone in python 3.13; there only the new parser runs.)
+"""
+import io
+import os
+import sys
+import timeit
+import warnings
+
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from slackbridge.body import parse_body  # noqa
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    try:
+        import cgi
+    except ImportError:
+        cgi = None
+
+BODY = urlencode({
+    'token': 'OutGoingTokenFromTeam1', 'team_id': 'T9999ZZZZ',
+    'team_domain': 'ossobv', 'service_id': '1234567890',
+    'channel_id': 'C9999ZZZZ', 'channel_name': 'crack',
+    'timestamp': '1425548120.000032', 'user_id': 'U9999ZZZZ',
+    'user_name': 'walter', 'text': (
+        'I used to work at Kwik-Fit, but I gave up the job; every day '
+        'I was tyred and exhausted. <@U9999ZZZZ> één keer')},
+).encode('utf-8')
+
+
+def environ():
+    return {
+        'REQUEST_METHOD': 'POST', 'PATH_INFO': '/outgoing',
+        'QUERY_STRING': '', 'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '8001', 'HTTP_HOST': 'localhost:8001',
+        'HTTP_USER_AGENT': 'Slackbot 1.0 (+https://api.slack.com/robots)',
+        'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+        'CONTENT_LENGTH': str(len(BODY)), 'wsgi.input': io.BytesIO(BODY)}
+
+
+def old_path():
+    env = environ()
+    post_env = env.copy()
+    post_env['QUERY_STRING'] = ''
+    payload = cgi.FieldStorage(fp=env['wsgi.input'], environ=post_env,
+                               keep_blank_values=True)
+    return dict((i, payload.getfirst(i)) for i in payload.keys())
+
+
+def new_path():
+    return parse_body(environ())
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    t_new = min(timeit.repeat(new_path, number=rounds, repeat=3))
+    if cgi:
+        assert old_path() == new_path()
+        t_old = min(timeit.repeat(old_path, number=rounds, repeat=3))
+        print('cgi.FieldStorage {:7.2f} us/request'.format(
+            t_old * 1e6 / rounds))
+    print('parse_body       {:7.2f} us/request'.format(t_new * 1e6 / rounds))
+    if cgi:
+        print('speedup {:.1f}x'.format(t_old / t_new))
+
+
+if __name__ == '__main__':
+    main()
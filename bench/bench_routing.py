@@ -0,0 +1,92 @@
+"""
+Compare the per-message config lookups on the old-style CONFIG dict
+with the precompiled routing table, and time building the table for
+many bridges.
+
+    python3 bench/bench_routing.py [bridges]
+"""
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from slackbridge.config.data import (  # noqa
+    BridgeConfig, BridgeConfigs, BridgeEndConfig)
+from slackbridge.rewrite import TextRewriter  # noqa
+
+
+def bridge_configs(count):
+    configs = BridgeConfigs()
+    for i in range(count):
+        pair = []
+        for side in 'AB':
+            end = BridgeEndConfig()
+            end.WEBHOOK_OUT_TOKEN = 'token-{}-{}'.format(i, side)
+            end.WEBHOOK_IN_URL = (
+                'https://hooks.slack.com/services/T{}/B{}/{}'.format(
+                    i, side, 'x' * 24))
+            end.CHANNEL = '#shared-{}'.format(i) if side == 'A' else 'C{}'
+            end.PEERNAME = 'company{}'.format(i) if side == 'A' else 'osso'
+            end.WEBAPI_TOKEN = 'xoxb-{}'.format(side)
+            pair.append(end)
+        configs.add_config(BridgeConfig('bridge-{}'.format(i), *pair))
+    return configs
+
+
+def old_lookup(config, owh_token):
+    # What respond() and outgoingwh_to_incomingwh() used to do.
+    values = config.get(owh_token)
+    reply_url = config[values['owh_linked']]['iwh_url']
+    update = values['iwh_update']
+    rewriter = TextRewriter.for_atchannel(update.get('_atchannel'))
+    payload = {'channel': '#local', 'link_names': 1}
+    payload.update(
+        dict((k, v) for k, v in update.items() if not k.startswith('_')))
+    return values['iwh_url'], reply_url, rewriter, payload
+
+
+def new_lookup(routes, owh_token):
+    route = routes.get(owh_token)
+    payload = {'channel': '#local', 'link_names': 1}
+    payload.update(route.template)
+    return route.peer_url, route.reply_url, route.rewriter, payload
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    configs = bridge_configs(count)
+
+    t0 = time.time()
+    config = configs.to_config_dict()
+    t_dict = time.time() - t0
+    t0 = time.time()
+    routes = configs.to_routing_table()
+    t_routes = time.time() - t0
+    print('{} bridges: CONFIG dict in {:.3f}s, routing table in {:.3f}s '
+          '({:.1f} us/route)'.format(
+              count, t_dict, t_routes, t_routes * 1e6 / len(routes)))
+
+    tokens = sorted(routes)
+    for token in tokens:
+        old, new = old_lookup(config, token), new_lookup(routes, token)
+        assert old == new, (old, new)
+
+    def run_old():
+        for token in tokens:
+            old_lookup(config, token)
+
+    def run_new():
+        for token in tokens:
+            new_lookup(routes, token)
+
+    t_old = min(timeit.repeat(run_old, number=5, repeat=3))
+    t_new = min(timeit.repeat(run_new, number=5, repeat=3))
+    per_msg = 1e6 / (5 * len(tokens))
+    print('CONFIG dict   {:6.2f} us/message'.format(t_old * per_msg))
+    print('routing table {:6.2f} us/message ({:.1f}x)'.format(
+        t_new * per_msg, t_old / t_new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Enqueue latency of RequestHandler.post(): sending an item through the
+worker pipe only, against journaling it to the Spool first (with group
+commit, and with an fsync per item).
+
+    python3 bench/bench_spool.py [items] [spool-dir]
+
+Put the spool directory on the disk you intend to use; fsync cost
+differs wildly between tmpfs, SSDs and spinning disks.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from multiprocessing import Pipe
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from slackbridge.spool import Spool  # noqa
+
+ITEM = {
+    'token': 'OutGoingTokenFromTeam1', 'team_id': 'T9999ZZZZ',
+    'team_domain': 'ossobv', 'channel_id': 'C9999ZZZZ',
+    'channel_name': 'crack', 'timestamp': '1425548120.000032',
+    'user_id': 'U9999ZZZZ', 'user_name': 'walter', 'service_id': '123',
+    'text': 'I used to work at Kwik-Fit, but I gave up the job; every '
+            'day I was tyred and exhausted.'}
+
+
+def drain(conn):
+    while conn.recv() is not None:
+        pass
+
+
+def run(label, count, spool=None):
+    parent, child = Pipe()
+    reader = threading.Thread(target=drain, args=(child,))
+    reader.start()
+    latencies = []
+    for i in range(count):
+        t0 = time.perf_counter()
+        if spool:
+            parent.send((spool.append(ITEM), ITEM))
+        else:
+            parent.send(ITEM)
+        latencies.append(time.perf_counter() - t0)
+    parent.send(None)
+    reader.join()
+    latencies.sort()
+    print('{:<22} mean {:8.1f} us  p50 {:8.1f} us  p99 {:8.1f} us'.format(
+        label, sum(latencies) / count * 1e6, latencies[count // 2] * 1e6,
+        latencies[int(count * 0.99)] * 1e6))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    base = tempfile.mkdtemp(dir=(sys.argv[2] if len(sys.argv) > 2 else None))
+    try:
+        run('pipe', count)
+        run('spool, fsync 0.1s', count, Spool(
+            os.path.join(base, 'group'), fsync_interval=0.1))
+        run('spool, fsync always', count, Spool(
+            os.path.join(base, 'always'), fsync_interval=0))
+    finally:
+        shutil.rmtree(base)
+
+
+if __name__ == '__main__':
+    main()
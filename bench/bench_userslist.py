@@ -0,0 +1,90 @@
+"""
+Memory use of loading users.list for a synthetic 100k-member workspace:
+the old single-document dict-of-dicts against the paginated WebApi with
+slotted User records.
+
+    python3 bench/bench_userslist.py [members]
+"""
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from slackbridge.webapi import UNSET, WebApi  # noqa
+
+
+def member(i):
+    return {
+        'id': 'U{:08X}'.format(i), 'team_id': 'T0000000', 'deleted': False,
+        'name': 'user.number{}'.format(i), 'real_name': 'User {}'.format(i),
+        'tz': 'Europe/Amsterdam', 'is_admin': False, 'is_bot': False,
+        'profile': {
+            'image_32': 'https://avatars.example.com/{}_32.png'.format(i),
+            'image_72': 'https://avatars.example.com/{}_72.png'.format(i),
+            'status_text': '', 'title': 'Employee'}}
+
+
+class Response(object):
+    def __init__(self, body):
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class FakeSlack(object):
+    def __init__(self, count):
+        self.count = count
+
+    def urlopen(self, url):
+        query = parse_qs(urlsplit(url).query)
+        start = int(query.get('cursor', ['0'])[0])
+        end = min(self.count, start + int(query.get('limit', ['0'])[0]))
+        if not query.get('limit'):
+            end = self.count  # old style: everything in one go
+        return Response(json.dumps({
+            'ok': True, 'members': [member(i) for i in range(start, end)],
+            'response_metadata': {
+                'next_cursor': str(end) if end < self.count else ''},
+        }).encode('utf-8'))
+
+
+def old_users_list(http):
+    data = http.urlopen('users.list?token=x').read()
+    data = json.loads(data.decode('utf-8', 'replace'))
+    return dict(
+        (i.get('id'),
+         {'name': i.get('name', UNSET),
+          'image_32': i.get('profile', {}).get('image_32')})
+        for i in data['members'] if not i.get('deleted', False))
+
+
+def measure(label, func):
+    gc.collect()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - t0
+    gc.collect()
+    kept, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:<10} {:7d} users  peak {:7.1f} MiB  kept {:6.1f} MiB  '
+          '{:.2f}s'.format(label, len(result), peak / 2 ** 20,
+                           kept / 2 ** 20, elapsed))
+    return result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    http = FakeSlack(count)
+    measure('old', lambda: old_users_list(http))
+    measure('paginated', lambda: WebApi(http, base_url='').users_list('x'))
+
+
+if __name__ == '__main__':
+    main()
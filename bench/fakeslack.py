@@ -0,0 +1,139 @@
+"""
+Local stand-in for the Slack Web API and incoming webhooks, for load
+tests. Answers users.list, conversations.list (both paginated),
+conversations.members, users.info, conversations.info and webhook
+posts, with configurable latency and error rate.
+
+    server = FakeSlack(users=1000, hook_latency=0.05, error_rate=0.01)
+    server.start()
+    ... post to server.hook_url(1), use server.api_url ...
+    server.stop()
+"""
+import json
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeSlackHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_json(self, data):
+        self.reply(200, json.dumps(data).encode('utf-8'))
+
+    def do_GET(self):
+        server = self.server.slack
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        method = url.path.rsplit('/', 1)[-1]
+        server.api_calls[method] = server.api_calls.get(method, 0) + 1
+        time.sleep(server.api_latency)
+
+        if method in ('users.list', 'conversations.list'):
+            key, items = (
+                ('members', server.users) if method == 'users.list'
+                else ('channels', server.channels))
+            self.reply_json(self.page(key, items, query))
+        elif method == 'conversations.members':
+            members = [
+                i['id'] for i in server.users[:server.members_per_channel]]
+            self.reply_json(self.page('members', members, query))
+        elif method == 'users.info':
+            user = server.users_by_id.get(query.get('user'))
+            self.reply_json(
+                {'ok': True, 'user': user} if user
+                else {'ok': False, 'error': 'user_not_found'})
+        elif method == 'conversations.info':
+            channel = server.channels_by_id.get(query.get('channel'))
+            self.reply_json(
+                {'ok': True, 'channel': channel} if channel
+                else {'ok': False, 'error': 'channel_not_found'})
+        else:
+            self.reply_json({'ok': False, 'error': 'unknown_method'})
+
+    @staticmethod
+    def page(key, items, query):
+        limit = int(query.get('limit', 100))
+        cursor = int(query.get('cursor') or 0)
+        next_cursor = cursor + limit
+        return {
+            'ok': True, key: items[cursor:next_cursor],
+            'response_metadata': {'next_cursor': (
+                str(next_cursor) if next_cursor < len(items) else '')}}
+
+    def do_POST(self):
+        server = self.server.slack
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(server.hook_latency)
+        if server.random.random() < server.error_rate:
+            server.errors += 1
+            self.reply(500, b'internal_error')
+            return
+        payload = json.loads(parse_qs(body.decode('utf-8'))['payload'][0])
+        server.delivered(self.path, payload)
+        self.reply(200, b'ok')
+
+
+class FakeSlack(object):
+    def __init__(self, users=1000, channels=100, members_per_channel=50,
+                 api_latency=0.0, hook_latency=0.0, error_rate=0.0,
+                 seed=1):
+        self.users = [
+            {'id': 'U{:06d}'.format(i), 'name': 'user{}'.format(i),
+             'profile': {'image_32': 'https://example.com/{}.png'.format(i)}}
+            for i in range(users)]
+        self.users_by_id = dict((i['id'], i) for i in self.users)
+        self.channels = [
+            {'id': 'C{:06d}'.format(i), 'name': 'channel{}'.format(i)}
+            for i in range(channels)]
+        self.channels_by_id = dict((i['id'], i) for i in self.channels)
+        self.members_per_channel = members_per_channel
+        self.api_latency = api_latency
+        self.hook_latency = hook_latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.api_calls = {}
+        self.errors = 0
+        self.posts = []  # (time, path, payload)
+        self._lock = threading.Lock()
+        self._httpd = None
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}'.format(self._httpd.server_address[1])
+
+    @property
+    def api_url(self):
+        return self.base_url + '/api/'
+
+    def hook_url(self, name):
+        return '{}/services/{}'.format(self.base_url, name)
+
+    def delivered(self, path, payload):
+        with self._lock:
+            self.posts.append((time.time(), path, payload))
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), FakeSlackHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.slack = self
+        thread = threading.Thread(target=self._httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
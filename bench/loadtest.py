@@ -0,0 +1,277 @@
+"""
+End-to-end load test: send synthetic outgoing webhook POSTs into
+wsgi.application, and let the workers deliver them to a local fake
+Slack (see fakeslack.py). Reports throughput, and the latency from
+receiving a message to its delivery to the incoming webhook.
+
+    python3 bench/loadtest.py [--messages 2000] [--bridges 20]
+        [--mode direct|http|asgi] [--rate 0] [--hook-latency 0.02]
+        [--api-latency 0.05] [--error-rate 0] [--set NAME=VALUE ...]
+
+--mode direct calls wsgi.application in this process; --mode http goes
+through a wsgiref server, like builtin_httpd; --mode asgi sends all
+messages to wsgi.asgi_application without waiting for the answers.
+Use --set to change the wsgi.py tunables, for example
+--set RESPONSE_WORKERS=4 or --set COALESCE_WINDOW=0.5, to compare
+worker models. The webhook rate
+limit is lifted, unless you --set WEBHOOK_RATE yourself.
+"""
+import argparse
+import ast
+import asyncio
+import io
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+from urllib import error, parse, request
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from fakeslack import FakeSlack  # noqa
+
+MESSAGE_ID = re.compile(r'\bload (\d+)\b')
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def write_config(path, slack, bridges):
+    with open(path, 'w') as fp:
+        for i in range(bridges):
+            fp.write('[bridge{}]\n'.format(i))
+            for side, channel in (('A', 'C{:06d}'.format(i)),
+                                  ('B', '#shared-{}'.format(i))):
+                fp.write(
+                    '{side}.webhook_in_url = {url}\n'
+                    '{side}.webhook_out_token = token{side}{i}\n'
+                    '{side}.channel = {channel}\n'
+                    '{side}.peername = peer{side}{i}\n'
+                    '{side}.webapi_token = xoxb-{side}\n'.format(
+                        side=side, i=i, channel=channel,
+                        url=slack.hook_url('{}{}'.format(side, i))))
+            fp.write('\n')
+
+
+def outgoing(number, bridges):
+    bridge, side = divmod(number, 2)
+    return {
+        'token': 'token{}{}'.format('AB'[side], bridge % bridges),
+        'team_id': 'T0001', 'channel_id': 'C{:06d}'.format(bridge % 100),
+        'channel_name': 'shared-{}'.format(bridge % bridges),
+        'timestamp': '{:.6f}'.format(time.time()),
+        'user_id': 'U{:06d}'.format(number % 1000),
+        'user_name': 'user{}'.format(number % 1000),
+        'text': 'load {} hi <@U000001>, see <#C000002> @peer{}{}'.format(
+            number, 'BA'[side], bridge % bridges),
+    }
+
+
+def post_direct(wsgi, fields):
+    body = parse.urlencode(fields).encode('utf-8')
+    environ = {
+        'REQUEST_METHOD': 'POST', 'PATH_INFO': '/outgoing',
+        'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+        'CONTENT_LENGTH': str(len(body)), 'wsgi.input': io.BytesIO(body)}
+    status = []
+    b''.join(wsgi.application(
+        environ, lambda s, headers, exc_info=None: status.append(s)))
+    return status[0]
+
+
+def post_http(url, fields):
+    body = parse.urlencode(fields).encode('utf-8')
+    try:
+        with request.urlopen(url, body) as response:
+            response.read()
+            return '{} {}'.format(response.status, response.reason)
+    except error.HTTPError as e:
+        return '{} {}'.format(e.code, e.reason)
+
+
+async def post_asgi(app, fields):
+    body = parse.urlencode(fields).encode('utf-8')
+    scope = {
+        'type': 'http', 'method': 'POST', 'path': '/outgoing', 'headers': [
+            (b'content-type', b'application/x-www-form-urlencoded'),
+            (b'content-length', str(len(body)).encode())]}
+    messages = [{'type': 'http.request', 'body': body}]
+    status = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(str(message['status']))
+
+    await app(scope, receive, send)
+    return status[0]
+
+
+def send_all_asgi(app, args):
+    # Does not wait for the answers before sending the next one.
+    async def main():
+        # Like an ASGI server: startup, requests, shutdown.
+        events = asyncio.Queue()
+        done = asyncio.Queue()
+        lifespan = asyncio.ensure_future(
+            app({'type': 'lifespan'}, events.get, done.put))
+        await events.put({'type': 'lifespan.startup'})
+        await done.get()
+        sent = {}
+        pending = []
+        t_start = time.time()
+        for number in range(args.messages):
+            if args.rate:
+                delay = t_start + number / args.rate - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            sent[number] = time.time()
+            pending.append(asyncio.ensure_future(
+                post_asgi(app, outgoing(number, args.bridges))))
+        statuses = await asyncio.gather(*pending)
+        failed = len([i for i in statuses if not i.startswith('200')])
+        await events.put({'type': 'lifespan.shutdown'})
+        await lifespan  # waits for the delivery loop
+        return sent, failed, t_start, time.time()
+
+    return asyncio.get_event_loop().run_until_complete(main())
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def send_all(send, args):
+    sent = {}
+    failed = 0
+    t_start = time.time()
+    for number in range(args.messages):
+        if args.rate:
+            delay = t_start + number / args.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        sent[number] = time.time()
+        if not send(outgoing(number, args.bridges)).startswith('200'):
+            failed += 1
+    return sent, failed, t_start, time.time()
+
+
+def run(wsgi, slack, args):
+    if args.mode == 'http':
+        # Serve from the main thread, like builtin_httpd; we send from
+        # another one.
+        httpd = make_server(
+            '127.0.0.1', 0, wsgi.application, handler_class=QuietHandler)
+        url = 'http://127.0.0.1:{}/outgoing'.format(httpd.server_port)
+        result = []
+
+        def sender():
+            try:
+                result.extend(send_all(
+                    (lambda fields: post_http(url, fields)), args))
+            finally:
+                httpd.shutdown()
+
+        thread = threading.Thread(target=sender)
+        thread.start()
+        httpd.serve_forever()
+        thread.join()
+        httpd.server_close()
+        sent, failed, t_start, t_sent = result
+    elif args.mode == 'asgi':
+        sent, failed, t_start, t_sent = send_all_asgi(
+            wsgi.asgi_application, args)
+    else:
+        sent, failed, t_start, t_sent = send_all(
+            (lambda fields: post_direct(wsgi, fields)), args)
+
+    latencies = {}
+    deadline = t_sent + args.timeout
+    seen = 0
+    while len(latencies) < len(sent) - failed and time.time() < deadline:
+        time.sleep(0.05)
+        posts = slack.posts[seen:]
+        seen += len(posts)
+        for t_posted, path, payload in posts:
+            for match in MESSAGE_ID.finditer(payload.get('text', '')):
+                number = int(match.group(1))
+                latencies.setdefault(number, t_posted - sent[number])
+    return sent, failed, t_start, t_sent, latencies
+
+
+def report(slack, sent, failed, t_start, t_sent, latencies):
+    t_done = max([sent[i] + j for i, j in latencies.items()] or [t_sent])
+    values = list(latencies.values())
+    print('sent {} messages in {:.2f}s ({:.0f}/s), {} refused'.format(
+        len(sent), t_sent - t_start, len(sent) / (t_sent - t_start), failed))
+    print('delivered {} in {:.2f}s ({:.0f}/s), {} posts, {} webhook '
+          'errors'.format(
+              len(values), t_done - t_start,
+              len(values) / max(t_done - t_start, 1e-9), len(slack.posts),
+              slack.errors))
+    print('latency: p50 {:.1f}ms, p90 {:.1f}ms, p99 {:.1f}ms, '
+          'max {:.1f}ms'.format(*(
+              1000 * percentile(values, i) for i in (50, 90, 99, 100))))
+    print('web api calls: {}'.format(', '.join(
+        '{} {}'.format(k, v) for k, v in sorted(slack.api_calls.items()))))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--bridges', type=int, default=20)
+    parser.add_argument('--mode', choices=('direct', 'http', 'asgi'),
+                        default='direct')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='messages per second to send, 0 for max')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--hook-latency', type=float, default=0.02)
+    parser.add_argument('--api-latency', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--timeout', type=float, default=120.0,
+                        help='seconds to wait for all deliveries')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='NAME=VALUE', help='set a wsgi.py tunable')
+    args = parser.parse_args()
+
+    slack = FakeSlack(
+        users=args.users, api_latency=args.api_latency,
+        hook_latency=args.hook_latency, error_rate=args.error_rate)
+    slack.start()
+
+    tmpdir = tempfile.mkdtemp(prefix='slackbridge-loadtest-')
+    config = os.path.join(tmpdir, 'slackbridge.ini')
+    write_config(config, slack, args.bridges)
+    os.environ['SLACKBRIDGE_INIFILE'] = config
+    import wsgi
+
+    wsgi.WA_BASE_URL = slack.api_url
+    wsgi.WEBHOOK_RATE = wsgi.WEBHOOK_BURST = 1e9
+    wsgi.mail_admins = lambda subject, body: None
+    for setting in args.set:
+        name, value = setting.split('=', 1)
+        setattr(wsgi, name, ast.literal_eval(value))
+
+    wsgi.init_globals()
+    try:
+        result = run(wsgi, slack, args)
+    finally:
+        wsgi.stop_workers()
+        slack.stop()
+    report(slack, *result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class AlertGroup(object):
+    """
+    All alerts of one kind, for one destination, since the last digest.
+    """
+    def __init__(self, kind, dest, now):
+        self.kind = kind
+        self.dest = dest
+        self.count = 0
+        self.first = self.last = now
+        self.error = None
+        self.samples = []
+
+    def add(self, now, error, details, max_samples):
+        self.count += 1
+        self.last = now
+        if error is not None:
+            self.error = error
+        if details and len(self.samples) < max_samples:
+            self.samples.append(details)
+
+    def merge(self, other, max_samples):
+        self.count += other.count
+        self.first = min(self.first, other.first)
+        self.last = max(self.last, other.last)
+        self.error = other.error if other.error is not None else self.error
+        self.samples = (self.samples + other.samples)[:max_samples]
+
+    def __str__(self):
+        lines = ['{}x {}{}, from {} to {}'.format(
+            self.count, self.kind,
+            (' for ' + self.dest) if self.dest else '',
+            _timestamp(self.first), _timestamp(self.last))]
+        if self.error is not None:
+            lines.append('Last error: {}'.format(self.error))
+        for i, details in enumerate(self.samples):
+            lines.append('--- sample {} ---\n{}'.format(
+                i + 1, '\n\n'.join(str(j) for j in details)))
+        if self.samples and self.count > len(self.samples):
+            lines.append('--- ({} more) ---'.format(
+                self.count - len(self.samples)))
+        return '\n'.join(lines)
+
+
+def _timestamp(when):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when))
+
+
+class Alerter(object):
+    """
+    Mails alerts to the admins as digests, from a thread of its own, so
+    that whoever raises one does not wait for SMTP.
+
+    Alerts are grouped by kind and destination. The first one is mailed
+    after delay seconds (to catch the ones that come with it), then at
+    most one digest goes out every interval seconds. If mailing fails,
+    the alerts are kept and mailed with the next digest; at most
+    max_groups groups (with max_samples details each) are kept.
+
+    alert() never blocks for long. Every process (workers are forked)
+    starts its own thread.
+    """
+    def __init__(self, send, delay=10, interval=300, max_groups=50,
+                 max_samples=3, clock=time.time):
+        self.send = send  # send(subject, body); may raise
+        self.delay = delay
+        self.interval = interval
+        self.max_groups = max_groups
+        self.max_samples = max_samples
+        self.clock = clock
+        self._pid = None
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._groups = OrderedDict()  # (kind, dest) -> AlertGroup
+        self._dropped = 0
+        self._next_send = 0
+        self._failures = 0
+        self._pid = os.getpid()
+        thread = threading.Thread(target=self._run, name='alerts')
+        thread.daemon = True
+        thread.start()
+
+    def alert(self, kind, dest=None, error=None, details=()):
+        if self._pid != os.getpid():
+            self._reset()
+        now = self.clock()
+        with self._lock:
+            if not self._groups:
+                self._next_send = max(self._next_send, now + self.delay)
+                self._wakeup.notify()
+            key = (kind, dest)
+            group = self._groups.get(key)
+            if group is None:
+                if len(self._groups) >= self.max_groups:
+                    self._dropped += 1
+                    return
+                group = self._groups[key] = AlertGroup(kind, dest, now)
+            group.add(now, error, details, self.max_samples)
+
+    def __len__(self):
+        if self._pid != os.getpid():
+            return 0
+        return len(self._groups)
+
+    def flush(self):
+        """
+        Mail what we have now, in this thread. For shutdown.
+        """
+        if self._pid == os.getpid():
+            self._send_digest()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._groups or self.clock() < self._next_send:
+                    self._wakeup.wait(
+                        None if not self._groups
+                        else max(0, self._next_send - self.clock()))
+            self._send_digest()
+
+    def _send_digest(self):
+        with self._lock:
+            groups, dropped = self._groups, self._dropped
+            self._groups, self._dropped = OrderedDict(), 0
+        if not groups:
+            return
+
+        kinds = OrderedDict()
+        for group in groups.values():
+            kinds[group.kind] = kinds.get(group.kind, 0) + group.count
+        total = sum(kinds.values()) + dropped
+        subject = 'Slackbridge: {} alert{}: {}'.format(
+            total, '' if total == 1 else 's', ', '.join(
+                '{}x {}'.format(count, kind) for kind, count in kinds.items()))
+        body = 'Please investigate.\n\n' + '\n\n'.join(
+            str(i) for i in groups.values())
+        if dropped:
+            body += '\n\n({} alerts of other kinds were dropped)'.format(
+                dropped)
+
+        try:
+            self.send(subject, body)
+        except Exception as e:
+            # Probably the MTA is down. Keep them for the next digest,
+            # and back off.
+            self._failures += 1
+            log.warning('Mailing %d alerts failed (%s), will retry', total, e)
+            self._keep(groups, dropped)
+            wait = self.interval * min(2 ** (self._failures - 1), 8)
+        else:
+            self._failures = 0
+            log.info('Mailed %d alerts', total)
+            wait = self.interval
+        with self._lock:
+            self._next_send = max(self._next_send, self.clock() + wait)
+
+    def _keep(self, groups, dropped):
+        with self._lock:
+            new, self._groups = self._groups, groups
+            self._dropped += dropped
+            for key, group in new.items():
+                if key in self._groups:
+                    self._groups[key].merge(group, self.max_samples)
+                elif len(self._groups) < self.max_groups:
+                    self._groups[key] = group
+                else:
+                    self._dropped += group.count
@@ -0,0 +1,196 @@
+import asyncio
+import io
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .body import BadRequest
+from .workers import ShardedQueue
+
+log = logging.getLogger(__name__)
+
+
+class AsgiFrontend(object):
+    """
+    ASGI (3.0) front-end for a RequestHandler.
+
+    Many outgoing webhook POSTs may be waiting at once. Each is parsed
+    in the event loop and put on a bounded queue, one for each of the
+    ``lanes`` (use the number of workers: messages go to the lane of
+    the worker they are for). The delivery loop of every lane hands
+    them to the handler (deduplication and the worker queue) in
+    batches, in a thread, so the event loop never blocks on a pipe or
+    socket, and a worker that does not keep up only holds up its own
+    lane. The POST is answered once its message is queued for the
+    workers, as with WSGI: a 503 makes Slack retry.
+
+    Everything else (the GETs) runs in a thread as well.
+    """
+    def __init__(self, handler, max_body_size=262144, queue_size=1000,
+                 batch_size=100, timeout=3.0, lanes=1, on_shutdown=None):
+        self.handler = handler
+        self.max_body_size = max_body_size
+        self.queue_size = queue_size  # per lane
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.lanes = max(1, lanes)
+        self.on_shutdown = on_shutdown
+        # A thread for every lane, and a few for the GETs.
+        self.executor = ThreadPoolExecutor(self.lanes + 2)
+        self.queues = None
+        self.tasks = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    def start(self):
+        # Lazily, so the queues belong to the loop we are running in.
+        if self.tasks is None:
+            self.queues = [
+                asyncio.Queue(self.queue_size) for i in range(self.lanes)]
+            self.tasks = [
+                asyncio.ensure_future(self.deliver_forever(queue))
+                for queue in self.queues]
+
+    async def stop(self):
+        if self.tasks is not None:
+            for queue in self.queues:
+                await queue.join()
+            for task in self.tasks:
+                task.cancel()
+            self.tasks = None
+        loop = asyncio.get_event_loop()
+        if self.on_shutdown:
+            await loop.run_in_executor(self.executor, self.on_shutdown)
+        self.executor.shutdown()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        self.start()
+        try:
+            environ = await self.get_environ(scope, receive)
+        except BadRequest as e:
+            log.info('Bad request: %s', e)
+            response = (e.status, [], e.status.split(' ', 1)[0].encode())
+        except EOFError:
+            return  # the client went away
+        else:
+            response = await self.handle(environ)
+
+        status, headers, body = response
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                        for k, v in headers]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def get_environ(self, scope, receive):
+        """
+        Return the bits of a WSGI environ that the handler uses.
+        """
+        headers = dict(
+            (k.decode('latin-1').lower(), v.decode('latin-1'))
+            for k, v in scope.get('headers', ()))
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            raise BadRequest('400 Bad Request', 'Bad Content-Length')
+
+        chunks = []
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                raise EOFError()
+            chunks.append(message.get('body', b''))
+            size += len(chunks[-1])
+            more_body = message.get('more_body', False)
+            if max(size, length) > self.max_body_size:
+                raise BadRequest(
+                    '413 Request Entity Too Large',
+                    'Body of {} bytes exceeds {}'.format(
+                        max(size, length), self.max_body_size))
+        body = b''.join(chunks)
+
+        return {
+            'REQUEST_METHOD': scope['method'],
+            'PATH_INFO': scope['path'],
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'CONTENT_TYPE': headers.get('content-type', ''),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': io.BytesIO(body),
+            'asgi.scope': scope,
+        }
+
+    async def handle(self, environ):
+        loop = asyncio.get_event_loop()
+        if (environ['REQUEST_METHOD'] != 'POST' or
+                self.handler.get_path_info(environ) != '/outgoing'):
+            return await loop.run_in_executor(
+                self.executor, self.handler.handle, environ)
+
+        try:
+            payload = self.handler.get_payload(environ)
+        except BadRequest as e:
+            log.info('Bad POST: %s', e)
+            return e.status, [], e.status.split(' ', 1)[0].encode()
+        future = loop.create_future()
+        queue = self.queues[ShardedQueue.shard_index(payload, self.lanes)]
+        try:
+            queue.put_nowait((payload, future))
+        except asyncio.QueueFull:
+            log.warning('Delivery queue full, refusing: %r', payload)
+            return '503 Queue full', [], b'503'
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            # The delivery loop skips it if it has not got to it yet.
+            log.warning('Delivery queue timeout, refusing: %r', payload)
+            return '503 Subprocess timeout', [], b'503'
+
+    async def deliver_forever(self, queue):
+        loop = asyncio.get_event_loop()
+        while True:
+            got = [await queue.get()]
+            while len(got) < self.batch_size and not queue.empty():
+                got.append(queue.get_nowait())
+            # Skip those that timed out waiting.
+            batch = [i for i in got if not i[1].done()]
+            try:
+                if batch:
+                    responses = await loop.run_in_executor(
+                        self.executor, self.deliver,
+                        [payload for payload, future in batch])
+                    for (payload, future), response in zip(
+                            batch, responses):
+                        if not future.done():
+                            future.set_result(response)
+            finally:
+                for i in got:
+                    queue.task_done()
+
+    def deliver(self, payloads):
+        # In the executor thread.
+        responses = []
+        for payload in payloads:
+            try:
+                responses.append(self.handler.outgoing(payload))
+            except Exception:
+                log.exception('Delivery failed for %r', payload)
+                responses.append(('500 Internal Server Error', [], b'500'))
+        return responses
@@ -0,0 +1,96 @@
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .webapi import workspace_key
+
+log = logging.getLogger(__name__)
+
+
+class Backfill(object):
+    """
+    Adds single users and channels that are missing from the cached
+    lists (new joiners, new channels), using users.info and
+    conversations.info, instead of fetching the whole lists again.
+
+    Lookups run in the background, at most ``threads`` at once; at
+    most ``max_pending`` may be waiting. An id that could not be found
+    is not looked up again for ``negative_ttl`` seconds. Found ones are
+    added to the list that was passed, so everyone using that cached
+    list sees them, until the list is refreshed.
+
+    If a metrics Counter is passed as ``lookups``, every request counts
+    as a (method, result) with result one of "found", "failed",
+    "negative" (known missing) or "full" (too many pending).
+    """
+    def __init__(self, api, threads=2, max_pending=100, negative_ttl=300,
+                 clock=time.time, lookups=None):
+        self.api = api
+        self.max_pending = max_pending
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.lookups = lookups
+        self._executor = ThreadPoolExecutor(max_workers=max(1, threads))
+        self._lock = threading.Lock()
+        self._pending = {}  # (method, workspace, id) -> Future
+        self._failed = {}  # (method, workspace, id) -> retry after
+
+    def user(self, wa_token, users_list, user_id):
+        """
+        Look up user_id and add it to users_list. Returns a Future, or
+        None if it will not be looked up.
+        """
+        return self._submit('users.info', wa_token, user_id, users_list)
+
+    def channel(self, wa_token, channels_list, channel_id):
+        return self._submit(
+            'conversations.info', wa_token, channel_id, channels_list)
+
+    def _count(self, method, result):
+        if self.lookups:
+            self.lookups.inc((method, result))
+
+    def _submit(self, method, wa_token, id_, target):
+        key = (method, workspace_key(wa_token), id_)
+        with self._lock:
+            future = self._pending.get(key)
+            if future:
+                return future
+            if self._failed.get(key, 0) > self.clock():
+                self._count(method, 'negative')
+                return None
+            if len(self._pending) >= self.max_pending:
+                log.info('Too many lookups pending, skipping %s %s',
+                         method, id_)
+                self._count(method, 'full')
+                return None
+            # (_lookup waits for the lock, so this is set first.)
+            future = self._pending[key] = self._executor.submit(
+                self._lookup, key, wa_token, target)
+        return future
+
+    def _lookup(self, key, wa_token, target):
+        method, workspace, id_ = key
+        try:
+            if method == 'users.info':
+                user = self.api.user_info(wa_token, id_)
+                target[user.id] = user
+            else:
+                target.add(self.api.channel_info(wa_token, id_))
+        except Exception as e:
+            log.info('Looking up %s %s failed: %s', method, id_, e)
+            self._count(method, 'failed')
+            now = self.clock()
+            with self._lock:
+                if len(self._failed) >= 10 * self.max_pending:
+                    self._failed = dict(
+                        (k, v) for k, v in self._failed.items() if v > now)
+                self._failed[key] = now + self.negative_ttl
+        else:
+            log.debug('Looked up %s %s', method, id_)
+            self._count(method, 'found')
+        finally:
+            with self._lock:
+                del self._pending[key]
@@ -0,0 +1,64 @@
+import json
+
+from urllib.parse import parse_qsl
+
+
+class BadRequest(ValueError):
+    def __init__(self, status, message):
+        super(BadRequest, self).__init__(message)
+        self.status = status
+
+
+def read_body(environ, max_size):
+    """
+    Read exactly CONTENT_LENGTH bytes from wsgi.input, refusing bodies
+    larger than max_size.
+    """
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        raise BadRequest('400 Bad Request', 'Bad Content-Length')
+    if length < 0:
+        raise BadRequest('400 Bad Request', 'Bad Content-Length')
+    if length > max_size:
+        raise BadRequest(
+            '413 Request Entity Too Large',
+            'Body of {} bytes exceeds {}'.format(length, max_size))
+    if not length:
+        return b''
+    data = environ['wsgi.input'].read(length)
+    if len(data) != length:
+        raise BadRequest('400 Bad Request', 'Short body')
+    return data
+
+
+def parse_body(environ, max_size=262144):
+    """
+    Return the POSTed fields as a dict of str. Supports
+    application/x-www-form-urlencoded (what Slack sends; for repeated
+    keys the first one wins) and application/json (an object).
+    """
+    content_type = environ.get('CONTENT_TYPE', '').split(';', 1)[0]
+    content_type = content_type.strip().lower()
+    data = read_body(environ, max_size)
+
+    if content_type in ('application/x-www-form-urlencoded', ''):
+        fields = {}
+        for key, value in parse_qsl(
+                data.decode('utf-8', 'replace'), keep_blank_values=True,
+                encoding='utf-8', errors='replace'):
+            fields.setdefault(key, value)
+        return fields
+
+    if content_type == 'application/json':
+        try:
+            fields = json.loads(data.decode('utf-8'))
+        except ValueError as e:
+            raise BadRequest('400 Bad Request', 'Bad JSON: {}'.format(e))
+        if not isinstance(fields, dict):
+            raise BadRequest('400 Bad Request', 'JSON body is not an object')
+        return fields
+
+    raise BadRequest(
+        '415 Unsupported Media Type',
+        'Unsupported Content-Type {!r}'.format(content_type))
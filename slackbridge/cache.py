@@ -0,0 +1,214 @@
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class CacheEntry(object):
+    def __init__(self, value, fetched, expires, ok):
+        self.value = value
+        self.fetched = fetched
+        self.expires = expires
+        self.ok = ok  # False if this is a negative (failed fetch) entry
+
+
+class Flight(object):
+    """
+    A fetch in progress; other threads wanting the same key wait for it.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+
+
+class TTLCache(object):
+    """
+    Per-key cache of values produced by ``fetch(*args)``.
+
+    - A missing key is fetched synchronously; this is the only time the
+      caller waits for ``fetch``. Pass a ``timeout`` to wait at most
+      that long: then the fetch goes on in the background, and you get
+      ``default()`` for now.
+    - A value older than ``ttl`` is still returned (it is *stale*), while
+      a background thread fetches a fresh one (stale-while-revalidate).
+    - If ``fetch`` raises, the failure is remembered for ``negative_ttl``
+      seconds. Until then we return the last good value, or ``default()``
+      if we never had one.
+
+    If a SnapshotStore is passed, fetched values are saved there (using
+    ``dump(value)``, which must return something JSON-serializable), and
+    values are taken from there (using ``load(data)``) when we do not
+    have them yet, or when another process has fetched a fresher value.
+    A new process can then serve from the snapshot right away, even if
+    it is stale, while it refreshes in the background.
+
+    Concurrent fetches of the same key are merged: one thread fetches,
+    the others wait for its result (single-flight).
+
+    If a metrics Counter is passed as ``lookups``, every get() counts as
+    a (name, result) with result one of "hit", "stale", "snapshot" or
+    "miss"; a miss that was not fetched within the timeout counts as
+    "timeout" as well.
+    """
+    def __init__(self, name, fetch, ttl=3600, negative_ttl=60,
+                 default=dict, clock=time.time, store=None,
+                 dump=None, load=None, lookups=None):
+        self.name = name
+        self.fetch = fetch
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.default = default
+        self.clock = clock
+        self.store = store
+        self.dump = dump or (lambda value: value)
+        self.load = load or (lambda data: data)
+        self.lookups = lookups
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._refreshing = set()
+        self._flights = {}
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def peek(self, key):
+        """
+        Return the cached value for key (stale or not), or None. Does
+        not fetch anything.
+        """
+        entry = self._entries.get(key)
+        return entry.value if entry else None
+
+    def get(self, key, *args, timeout=None):
+        entry, result = self._entries.get(key), 'hit'
+        if entry is None:
+            entry, result = self._from_store(key), 'snapshot'
+            if entry is None:
+                self._count('miss')
+                if timeout is None:
+                    return self._refresh(key, args).value
+                return self._refresh_within(key, args, timeout).value
+
+        if entry.expires <= self.clock():
+            if result == 'hit':
+                result = 'stale'
+            with self._lock:
+                start = key not in self._refreshing
+                self._refreshing.add(key)
+            if start:
+                thread = threading.Thread(
+                    target=self._refresh, args=(key, args),
+                    name='refresh {} {}'.format(self.name, key))
+                thread.daemon = True
+                thread.start()
+        self._count(result)
+        return entry.value
+
+    def _count(self, result):
+        if self.lookups:
+            self.lookups.inc((self.name, result))
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _from_store(self, key, newer_than=None):
+        if not self.store:
+            return None
+        if newer_than is not None:
+            fetched = self.store.fetched(self.name, key)
+            if (not fetched or fetched <= newer_than or
+                    fetched + self.ttl <= self.clock()):
+                return None
+        snapshot = self.store.load(self.name, key)
+        if snapshot is None:
+            return None
+        fetched, data = snapshot
+        try:
+            value = self.load(data)
+        except Exception as e:
+            log.error('Loading %s snapshot for %s failed: %s',
+                      self.name, key, e)
+            return None
+        entry = CacheEntry(value, fetched, fetched + self.ttl, True)
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+
+    def _refresh_within(self, key, args, timeout):
+        with self._lock:
+            flight = self._flights.get(key)
+        if flight:
+            flight.done.wait(timeout)
+        else:
+            thread = threading.Thread(
+                target=self._refresh, args=(key, args),
+                name='fetch {} {}'.format(self.name, key))
+            thread.daemon = True
+            thread.start()
+            thread.join(timeout)
+        entry = self._entries.get(key)
+        if entry is None:
+            log.warning('Fetching %s for %s takes longer than %.1fs',
+                        self.name, key, timeout)
+            self._count('timeout')
+            entry = CacheEntry(self.default(), 0, 0, False)
+        return entry
+
+    def _refresh(self, key, args):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+        if not leader:
+            log.debug('Waiting for %s fetch of %s', self.name, key)
+            flight.done.wait()
+            return flight.entry or self._entries.get(key) or CacheEntry(
+                self.default(), 0, 0, False)
+
+        try:
+            flight.entry = self._fetch(key, args)
+        finally:
+            with self._lock:
+                del self._flights[key]
+                self._refreshing.discard(key)
+            flight.done.set()
+        return flight.entry
+
+    def _fetch(self, key, args):
+        # Maybe another process has refreshed it for us already.
+        old = self._entries.get(key)
+        entry = self._from_store(
+            key, newer_than=(old.fetched if old else 0))
+        if entry:
+            return entry
+
+        try:
+            value = self.fetch(*args)
+        except Exception as e:
+            log.error('Fetching %s for %s failed: %s', self.name, key, e)
+            now = self.clock()
+            with self._lock:
+                old = self._entries.get(key)
+                entry = CacheEntry(
+                    (old.value if old else self.default()),
+                    (old.fetched if old else 0), now + self.negative_ttl,
+                    False)
+                self._entries[key] = entry
+            return entry
+
+        now = self.clock()
+        entry = CacheEntry(value, now, now + self.ttl, True)
+        with self._lock:
+            self._entries[key] = entry
+        if self.store:
+            try:
+                data = self.dump(value)
+            except Exception as e:
+                log.error('Dumping %s snapshot for %s failed: %s',
+                          self.name, key, e)
+            else:
+                self.store.save(self.name, key, data, now)
+        return entry
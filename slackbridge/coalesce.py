@@ -0,0 +1,86 @@
+import time
+
+
+class PendingPost(object):
+    def __init__(self, dest, payload, context, started):
+        self.dest = dest
+        self.payload = payload
+        self.context = context  # of the first payload
+        self.contexts = [context]  # of all merged payloads
+        self.started = started
+        self.count = 1
+
+
+class Coalescer(object):
+    """
+    Merge consecutive payloads for the same destination into one.
+
+    A payload is held for up to ``window`` seconds. If the next payload
+    for the same destination differs only in its text (same username,
+    icon and channel), its text is appended to the held one. Anything
+    else, or a text longer than ``max_chars``, flushes the held payload
+    first.
+
+    ``flush(pending)`` is called for every payload that goes out. With a
+    window of 0 (the default), payloads are flushed immediately.
+    """
+    def __init__(self, flush, window=0, max_chars=3000, clock=time.time):
+        self.flush = flush
+        self.window = window
+        self.max_chars = max_chars
+        self.clock = clock
+        self._pending = {}  # dest -> PendingPost
+
+    def __len__(self):
+        return len(self._pending)
+
+    def pending(self):
+        return list(self._pending.values())
+
+    @staticmethod
+    def mergeable(a, b):
+        return (set(a) == set(b) and
+                all(a[k] == b[k] for k in a if k != 'text'))
+
+    def add(self, dest, payload, context=None):
+        if self.window <= 0:
+            self.flush(PendingPost(dest, payload, context, self.clock()))
+            return
+
+        pending = self._pending.get(dest)
+        if pending:
+            text = pending.payload['text'] + '\n' + payload['text']
+            if (len(text) <= self.max_chars and
+                    self.mergeable(pending.payload, payload)):
+                pending.payload['text'] = text
+                pending.contexts.append(context)
+                pending.count += 1
+                return
+            self.flush_dest(dest)
+
+        self._pending[dest] = PendingPost(
+            dest, dict(payload), context, self.clock())
+
+    def flush_dest(self, dest):
+        pending = self._pending.pop(dest, None)
+        if pending:
+            self.flush(pending)
+
+    def flush_all(self):
+        for dest in list(self._pending):
+            self.flush_dest(dest)
+
+    def flush_due(self):
+        deadline = self.clock() - self.window
+        for dest, pending in list(self._pending.items()):
+            if pending.started <= deadline:
+                self.flush_dest(dest)
+
+    def timeout(self):
+        """
+        Seconds until the next held payload must go out, or None.
+        """
+        if not self._pending:
+            return None
+        first = min(i.started for i in self._pending.values())
+        return max(0.0, first + self.window - self.clock())
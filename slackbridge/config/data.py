@@ -1,3 +1,6 @@
+from .routing import Route, routing_table
+
+
 class BridgeEndConfig(object):
     """
     All settings are mandatory, except the WEBAPI_TOKEN. However, it is
@@ -50,6 +53,22 @@ class BridgeConfigs(object):
     def add_config(self, bridgeconfig):
         self._pairs.append(bridgeconfig)
 
+    def to_routing_table(self):
+        """
+        Compile the settings into a read-only dict of outgoing webhook
+        token to Route.
+        """
+        routes = []
+        for pair in self._pairs:
+            for our, their in (
+                    (pair.SIDE_A, pair.SIDE_B), (pair.SIDE_B, pair.SIDE_A)):
+                routes.append(Route(
+                    our.WEBHOOK_OUT_TOKEN, their.WEBHOOK_OUT_TOKEN,
+                    their.WEBHOOK_IN_URL, our.WEBHOOK_IN_URL,
+                    their.CHANNEL, our.PEERNAME,
+                    wa_token=our.WEBAPI_TOKEN))
+        return routing_table(routes)
+
     def to_config_dict(self):
         """
         Convert settings into old-style CONFIG dict.
@@ -0,0 +1,81 @@
+from types import MappingProxyType
+
+from slackbridge.rewrite import TextRewriter
+
+
+class Route(object):
+    """
+    Everything needed to forward a message that came in with one
+    outgoing webhook token. Built once when the config is loaded, and
+    immutable after that.
+
+    - peer_url: the incoming webhook URL of the other side;
+    - reply_url: our own incoming webhook URL, for local replies;
+    - channel: the channel we post to on the other side;
+    - atchannel: the "@peername" that becomes "@channel" on the other
+      side, and the rewriter that does that;
+    - template: the fields to set on every payload for the other side.
+    """
+    __slots__ = (
+        'token', 'peer_token', 'peer_url', 'reply_url', 'channel',
+        'atchannel', 'wa_token', 'rewriter', 'template')
+
+    def __init__(self, token, peer_token, peer_url, reply_url, channel,
+                 atchannel, wa_token=None, template=None):
+        set_ = super(Route, self).__setattr__
+        set_('token', token)
+        set_('peer_token', peer_token)
+        set_('peer_url', peer_url)
+        set_('reply_url', reply_url)
+        set_('channel', channel)
+        set_('atchannel', atchannel)
+        set_('wa_token', wa_token or None)
+        set_('rewriter', TextRewriter.for_atchannel(atchannel))
+        if template is None:
+            template = {'channel': channel}
+        set_('template', tuple(sorted(template.items())))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Route is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Route is immutable')
+
+    def __reduce__(self):
+        # For pickling (to workers started with spawn or forkserver):
+        # build it anew, rewriter and all.
+        return (Route, (
+            self.token, self.peer_token, self.peer_url, self.reply_url,
+            self.channel, self.atchannel, self.wa_token,
+            dict(self.template)))
+
+    def __repr__(self):
+        # No tokens or URLs; those are secrets.
+        return '<Route {} @{}>'.format(self.channel, self.atchannel)
+
+
+def routing_table(routes):
+    """
+    Return a read-only dict of outgoing webhook token to Route. This
+    cannot be pickled; pass dict(table) to another process.
+    """
+    return MappingProxyType(dict((route.token, route) for route in routes))
+
+
+def routes_from_config_dict(config):
+    """
+    Compile an old-style CONFIG dict (see BridgeConfigs.to_config_dict)
+    into a routing table.
+    """
+    routes = []
+    for token, values in config.items():
+        update = values.get('iwh_update', {})
+        peer_token = values.get('owh_linked')
+        routes.append(Route(
+            token, peer_token, values['iwh_url'],
+            config.get(peer_token, {}).get('iwh_url'),
+            update.get('channel'), update.get('_atchannel'),
+            wa_token=values.get('wa_token'),
+            template=dict(
+                (k, v) for k, v in update.items() if not k.startswith('_'))))
+    return routing_table(routes)
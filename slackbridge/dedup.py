@@ -0,0 +1,147 @@
+import logging
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+
+from .snapshot import SQLiteFile
+
+log = logging.getLogger(__name__)
+
+
+class RecentKeys(object):
+    """
+    Bounded in-process set of the keys seen in the last ttl seconds,
+    holding at most max_size of them (the oldest are forgotten first).
+    """
+    def __init__(self, ttl=600, max_size=10000, clock=time.time):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()  # key -> time first seen, oldest first
+
+    def __len__(self):
+        return len(self._seen)
+
+    def seen(self, key):
+        """
+        Return whether key was seen before; remember it if not.
+        """
+        now = self.clock()
+        with self._lock:
+            first = self._seen.get(key)
+            if first is not None and first > now - self.ttl:
+                return True
+            self._seen.pop(key, None)
+            self._seen[key] = now
+            while self._seen and (
+                    len(self._seen) > self.max_size or
+                    next(iter(self._seen.values())) <= now - self.ttl):
+                self._seen.popitem(last=False)
+            return False
+
+    def forget(self, key):
+        with self._lock:
+            self._seen.pop(key, None)
+
+
+class SharedRecentKeys(SQLiteFile):
+    """
+    Like RecentKeys, but in an SQLite database, shared by all processes
+    on this host.
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS seen (
+            key TEXT NOT NULL PRIMARY KEY,
+            seen REAL NOT NULL)
+    '''
+    # Take the write lock before looking, so two processes cannot both
+    # decide that a key is new.
+    ISOLATION_LEVEL = 'IMMEDIATE'
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path, ttl=600, max_size=10000, clock=time.time):
+        super(SharedRecentKeys, self).__init__(path)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._added = 0
+
+    def seen(self, key):
+        now = self.clock()
+        try:
+            with self._connection() as conn:
+                # Replace it only if it has expired.
+                added = conn.execute(
+                    'INSERT OR REPLACE INTO seen (key, seen) '
+                    'SELECT ?, ? WHERE NOT EXISTS ('
+                    ' SELECT 1 FROM seen WHERE key = ? AND seen > ?)',
+                    (key, now, key, now - self.ttl)).rowcount
+                self._added += added
+                if self._added >= self.PRUNE_EVERY:
+                    self._added = 0
+                    self._prune(conn, now)
+        except sqlite3.Error as e:
+            log.error('Checking seen key failed: %s', e)
+            return False  # better a duplicate than a lost message
+        return not added
+
+    def forget(self, key):
+        try:
+            with self._connection() as conn:
+                conn.execute('DELETE FROM seen WHERE key = ?', (key,))
+        except sqlite3.Error as e:
+            log.error('Forgetting seen key failed: %s', e)
+
+    def _prune(self, conn, now):
+        conn.execute('DELETE FROM seen WHERE seen <= ?', (now - self.ttl,))
+        conn.execute(
+            'DELETE FROM seen WHERE key IN ('
+            ' SELECT key FROM seen ORDER BY seen DESC LIMIT -1 OFFSET ?)',
+            (self.max_size,))
+
+
+class Deduplicator(object):
+    """
+    Drops repeated deliveries of the same message. Slack retries an
+    outgoing webhook when we do not answer fast enough; a message is
+    identified by (team_id, channel_id, timestamp).
+
+    Keys are looked up in this process first. If a path is given, they
+    are then checked in a database shared by all front-end processes.
+    """
+    def __init__(self, ttl=600, max_size=10000, path=None):
+        self.local = RecentKeys(ttl=ttl, max_size=max_size)
+        self.shared = path and SharedRecentKeys(
+            path, ttl=ttl, max_size=max_size)
+
+    @staticmethod
+    def key(payload):
+        try:
+            parts = (payload['team_id'], payload['channel_id'],
+                     payload['timestamp'])
+        except KeyError:
+            return None
+        if not all(parts):
+            return None
+        return '{} {} {}'.format(*parts)
+
+    def is_duplicate(self, payload):
+        key = self.key(payload)
+        if key is None:
+            return False  # cannot tell
+        if self.local.seen(key):
+            return True
+        return bool(self.shared and self.shared.seen(key))
+
+    def forget(self, payload):
+        """
+        We could not handle it after all; let a retry through.
+        """
+        key = self.key(payload)
+        if key is not None:
+            self.local.forget(key)
+            if self.shared:
+                self.shared.forget(key)
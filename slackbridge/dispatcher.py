@@ -0,0 +1,189 @@
+import errno
+import fcntl
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class DispatcherRequestHandler(socketserver.StreamRequestHandler):
+    """
+    One JSON object per line in, one JSON object per line out:
+
+        {"op": "send", "item": ...}  ->  {"ok": true}
+        {"op": "stats"}              ->  {"ok": true, "stats": [...]}
+        {"op": "metrics"}            ->  {"ok": true, "metrics": "..."}
+        {"op": "health"}             ->  {"ok": true, "health": [...]}
+    """
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                reply = self.server.dispatch(request)
+            except TimeoutError as e:
+                log.warning('Dispatcher request timed out: %s', e)
+                reply = {'ok': False, 'error': str(e), 'timeout': True}
+            except Exception as e:
+                log.exception('Dispatcher request failed')
+                reply = {'ok': False, 'error': str(e)}
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+
+class DispatcherServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    """
+    Accepts items from all front-end processes on a local Unix socket
+    and hands them to a single ShardedQueue. That gives one set of
+    workers and caches per host, and one order per channel.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, queue, metrics=None):
+        self.queue = queue
+        self.metrics = metrics  # returns the worker metrics as text
+        self._lockfd = self._lock_path(path)
+        if os.path.exists(path):
+            os.unlink(path)  # stale; we hold the lock
+        socketserver.UnixStreamServer.__init__(
+            self, path, DispatcherRequestHandler)
+
+    @staticmethod
+    def _lock_path(path):
+        fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                raise RuntimeError(
+                    'Another dispatcher is running on {}'.format(path))
+            raise
+        return fd
+
+    def dispatch(self, request):
+        op = request.get('op')
+        if op == 'send':
+            # Every connection has its own thread; the ShardedQueue
+            # only makes those for the same shard take turns.
+            self.queue.send(request.get('item'))
+            return {'ok': True}
+        elif op == 'stats':
+            return {'ok': True, 'stats': [str(i) for i in self.queue.stats()]}
+        elif op == 'health':
+            return {'ok': True, 'health': self.queue.health()}
+        elif op == 'metrics':
+            return {'ok': True,
+                    'metrics': (self.metrics() if self.metrics else '')}
+        raise ValueError('Unknown op {!r}'.format(op))
+
+
+class DispatcherClient(object):
+    """
+    Front-end side of the DispatcherServer. Has the same send() and
+    stats() as the ShardedQueue, so the RequestHandler can use either.
+    It may be used from many threads at once; each call gets a
+    connection of its own.
+
+    The timeout must be longer than the send_timeout of the dispatcher's
+    ShardedQueue, so that we get its answer when a worker is not taking
+    items, instead of giving up while it may still queue the item.
+    """
+    def __init__(self, path, timeout=3.0):
+        self.path = path
+        self.timeout = timeout
+        # Idle connections; every thread takes one (or makes a new one)
+        # for the duration of a call.
+        self._lock = threading.Lock()
+        self._idle = []  # (sock, rfile)
+        self._pid = None
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except (IOError, OSError):
+            sock.close()
+            raise
+        return sock, sock.makefile('rb')
+
+    @staticmethod
+    def _close(conn):
+        sock, rfile = conn
+        rfile.close()
+        sock.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._close(conn)
+
+    def _call(self, request):
+        data = json.dumps(request).encode('utf-8') + b'\n'
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked: those are our parent's.
+                stale, self._idle = self._idle, []
+                self._pid = os.getpid()
+            else:
+                stale = []
+            conn = self._idle.pop() if self._idle else None
+        for i in stale:
+            self._close(i)
+
+        reused = conn is not None
+        if not reused:
+            conn = self._connect()
+        try:
+            try:
+                conn[0].sendall(data)
+            except (IOError, OSError):
+                if not reused:
+                    raise
+                # The dispatcher closed the connection since we last
+                # used it (restarted, say); it got nothing, so send it
+                # again. Never after the request went out: it could be
+                # handled twice.
+                self._close(conn)
+                conn = self._connect()
+                conn[0].sendall(data)
+            line = conn[1].readline()
+            if not line:
+                raise IOError('dispatcher closed the connection')
+        except (IOError, OSError):
+            self._close(conn)
+            raise
+        with self._lock:
+            self._idle.append(conn)
+        reply = json.loads(line.decode('utf-8'))
+        if not reply.get('ok'):
+            error = TimeoutError if reply.get('timeout') else IOError
+            raise error('dispatcher: {}'.format(reply.get('error')))
+        return reply
+
+    def send(self, item):
+        self._call({'op': 'send', 'item': item})
+
+    def stats(self):
+        try:
+            return self._call({'op': 'stats'})['stats']
+        except (IOError, OSError) as e:
+            return ['dispatcher {}: {}'.format(self.path, e)]
+
+    def health(self):
+        try:
+            return self._call({'op': 'health'})['health']
+        except (IOError, OSError) as e:
+            return [{'dispatcher': self.path, 'alive': False,
+                     'error': str(e)}]
+
+    def metrics(self):
+        try:
+            return self._call({'op': 'metrics'})['metrics']
+        except (IOError, OSError) as e:
+            return '# dispatcher {}: {}\n'.format(self.path, e)
@@ -0,0 +1,201 @@
+import http.client as httplib
+import io
+import os
+import socket
+import ssl
+import threading
+import time
+
+from urllib.parse import urlsplit
+
+USER_AGENT = 'slackbridge'
+
+# Errors that mean the kept-alive connection was closed by the peer
+# before we reused it. The request can be retried on a fresh connection.
+STALE_CONNECTION_ERRORS = (
+    httplib.BadStatusLine, httplib.CannotSendRequest,
+    ConnectionResetError, BrokenPipeError)
+
+
+class DeadlineExceeded(socket.timeout):
+    """
+    Raised when a request does not finish before its deadline. Like
+    connect and read timeouts, it is a socket.timeout.
+    """
+
+
+class HTTPError(IOError):
+    """
+    Raised for HTTP status >= 400. Like urllib's HTTPError, the response
+    body is available through ``fp``.
+    """
+    def __init__(self, url, code, reason, headers, body):
+        super(HTTPError, self).__init__(
+            'HTTP Error {}: {}'.format(code, reason))
+        self.url = url
+        self.code = code
+        self.reason = reason
+        self.headers = headers
+        self.fp = io.BytesIO(body)
+
+
+class Response(object):
+    """
+    A fully read response; the connection has already gone back to the
+    pool when you get this.
+    """
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._body = body
+
+    def getcode(self):
+        return self.status
+
+    def read(self):
+        return self._body
+
+
+class ConnectionPool(object):
+    """
+    Persistent HTTP/1.1 connections, kept per (scheme, host, port).
+
+    Use ``urlopen(url, data=None)`` like ``urllib.request.urlopen``; the
+    difference is that the DNS lookup, TCP connect and TLS handshake
+    are done only once per connection instead of once per request.
+
+    Connections are never shared between threads: a connection is taken
+    out of the pool for the duration of one request. After a fork the
+    child starts with an empty pool.
+
+    Every request gets at most connect_timeout seconds to connect (and
+    do the TLS handshake), read_timeout seconds for every read, and
+    total_timeout seconds altogether, or until the deadline passed to
+    urlopen(), if that is sooner. Timeouts raise socket.timeout.
+    """
+    def __init__(self, maxsize=4, context=None, connect_timeout=None,
+                 read_timeout=None, total_timeout=None, clock=time.time):
+        self.maxsize = maxsize
+        self.context = context or ssl.create_default_context()
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._pid = os.getpid()
+
+    def _key(self, url):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ('http', 'https'):
+            raise ValueError('Unsupported URL scheme: {!r}'.format(url))
+        port = parts.port or (443 if scheme == 'https' else 80)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        return (scheme, parts.hostname, port), path
+
+    def _connect(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, context=self.context)
+        return httplib.HTTPConnection(host, port)
+
+    def _timeout(self, timeout, deadline):
+        """
+        Return the socket timeout for the next step: timeout, but no
+        later than the deadline.
+        """
+        if deadline is None:
+            return timeout
+        left = deadline - self.clock()
+        if left <= 0:
+            raise DeadlineExceeded('deadline exceeded')
+        return left if timeout is None else min(timeout, left)
+
+    def _get(self, key):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked: the sockets belong to our parent.
+                self._idle = {}
+                self._pid = os.getpid()
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._connect(key), False
+
+    def _put(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize and self._pid == os.getpid():
+                idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def urlopen(self, url, data=None, headers=None, deadline=None):
+        if self.total_timeout is not None:
+            total = self.clock() + self.total_timeout
+            deadline = total if deadline is None else min(deadline, total)
+        key, path = self._key(url)
+        method = 'GET' if data is None else 'POST'
+        all_headers = {'User-Agent': USER_AGENT}
+        if data is not None:
+            all_headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        all_headers.update(headers or {})
+
+        while True:
+            conn, reused = self._get(key)
+            try:
+                if conn.sock is None:
+                    conn.timeout = self._timeout(
+                        self.connect_timeout, deadline)
+                    conn.connect()
+                conn.sock.settimeout(
+                    self._timeout(self.read_timeout, deadline))
+                conn.request(method, path, body=data, headers=all_headers)
+                response = conn.getresponse()
+                body = self._read(conn, response, deadline)
+            except STALE_CONNECTION_ERRORS:
+                conn.close()
+                if reused:
+                    continue  # the server closed it while idle, try anew
+                raise
+            except Exception:
+                conn.close()
+                raise
+            break
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._put(key, conn)
+
+        if response.status >= 400:
+            raise HTTPError(
+                url, response.status, response.reason,
+                response.msg, body)
+        return Response(
+            url, response.status, response.reason, response.msg, body)
+
+    def _read(self, conn, response, deadline):
+        if deadline is None:
+            return response.read()
+        # In pieces, so that a slow trickle cannot take longer than the
+        # deadline either.
+        chunks = []
+        while True:
+            conn.sock.settimeout(self._timeout(self.read_timeout, deadline))
+            chunk = response.read(65536)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
@@ -0,0 +1,58 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Lane(object):
+    """
+    A few threads for slow work, like commands, that must not hold up
+    the forwarding of ordinary messages. At most max_pending jobs may
+    be waiting or running; submit() refuses more.
+
+    The jobs run in the lane; their callbacks run in the thread that
+    calls run_finished() (the worker loop), so they may post messages.
+    """
+    def __init__(self, threads=2, max_pending=20):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max(1, threads))
+        self._jobs = []  # (future, callback, seq), oldest first
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def submit(self, callback, func, *args, **kwargs):
+        """
+        Run func(*args) in the lane, and later callback(result) from
+        run_finished(). Pass seq to keep that spool sequence number
+        unacknowledged meanwhile. Returns False if the lane is full.
+        """
+        seq = kwargs.pop('seq', None)
+        assert not kwargs, kwargs
+        if len(self._jobs) >= self.max_pending:
+            return False
+        future = self._executor.submit(func, *args)
+        self._jobs.append((future, callback, seq))
+        return True
+
+    def seqs(self):
+        return set(seq for future, callback, seq in self._jobs)
+
+    def timeout(self):
+        """
+        Return how soon to look for finished jobs, or None if there are
+        none.
+        """
+        if not self._jobs:
+            return None
+        return 0 if any(i[0].done() for i in self._jobs) else 0.05
+
+    def run_finished(self):
+        """
+        Call the callbacks of the finished jobs. If a job failed, its
+        exception is raised here (and the job is forgotten).
+        """
+        for job in [i for i in self._jobs if i[0].done()]:
+            self._jobs.remove(job)
+            future, callback, seq = job
+            callback(future.result())
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,174 @@
+import bisect
+
+from multiprocessing import Array
+
+# Seconds; from a fast local pipe write up to a slow Slack post.
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric(object):
+    """
+    A metric in shared memory, so that it can be updated by all
+    processes forked after it was created. Create them before starting
+    the workers. Workers that are not forked (spawn, forkserver) must
+    attach() to the shared memory of the parent.
+
+    All label value combinations must be given up front, as ``values``:
+    a list of tuples, one value for each of the ``labels``.
+    """
+    TYPE = None
+    _data = None
+
+    def __init__(self, name, help, labels=(), values=((),)):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = [
+            (i if isinstance(i, tuple) else (i,)) for i in values]
+        self._index = dict((v, i) for i, v in enumerate(self.values))
+
+    def _slot(self, values):
+        if not isinstance(values, tuple):
+            values = (values,)
+        return self._index[values]
+
+    def _labels(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(
+            '{}="{}"'.format(k, _escape(v)) for k, v in pairs) + '}'
+
+    def shared(self):
+        return self._data
+
+    def attach(self, data):
+        if data is not None:
+            self._data = data
+
+    def samples(self):
+        """
+        Yield (suffix, labels, value) for all samples.
+        """
+        raise NotImplementedError()
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.TYPE)]
+        for suffix, labels, value in self.samples():
+            lines.append('{}{}{} {}'.format(
+                self.name, suffix, labels, _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def __init__(self, name, help, labels=(), values=((),)):
+        super(Counter, self).__init__(name, help, labels, values)
+        self._data = Array('d', len(self.values))
+
+    def inc(self, values=(), amount=1):
+        slot = self._slot(values)
+        with self._data.get_lock():
+            self._data[slot] += amount
+
+    def get(self, values=()):
+        return self._data[self._slot(values)]
+
+    def samples(self):
+        data = self._data[:]
+        for slot, values in enumerate(self.values):
+            yield '', self._labels(values), data[slot]
+
+
+class Gauge(Metric):
+    """
+    A value that is read when rendering, from func(), which returns a
+    list of (values, value).
+    """
+    TYPE = 'gauge'
+
+    def __init__(self, name, help, func, labels=()):
+        super(Gauge, self).__init__(name, help, labels)
+        self.func = func
+
+    def samples(self):
+        for values, value in self.func():
+            if not isinstance(values, tuple):
+                values = (values,)
+            yield '', self._labels(values), value
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labels=(), values=((),),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels, values)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: one count per bucket, one for +Inf, the sum.
+        self._width = len(self.buckets) + 2
+        self._data = Array('d', len(self.values) * self._width)
+
+    def observe(self, value, values=()):
+        base = self._slot(values) * self._width
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._data.get_lock():
+            self._data[base + bucket] += 1
+            self._data[base + self._width - 1] += value
+
+    def samples(self):
+        data = self._data[:]
+        for slot, values in enumerate(self.values):
+            base = slot * self._width
+            total = 0
+            for bucket, le in enumerate(self.buckets + (float('inf'),)):
+                total += data[base + bucket]
+                yield '_bucket', self._labels(
+                    values, [('le', _number(le))]), total
+            yield '_sum', self._labels(values), data[base + self._width - 1]
+            yield '_count', self._labels(values), total
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def shared(self):
+        """
+        Return the shared memory of all metrics. Pass it to a worker
+        that is not forked (as a Process argument), to attach() to.
+        """
+        return [metric.shared() for metric in self.metrics]
+
+    def attach(self, shared):
+        """
+        Use the shared memory from shared() in the parent, instead of
+        our own: the worker imported the same metrics again.
+        """
+        for metric, data in zip(self.metrics, shared):
+            metric.attach(data)
+
+    def render(self):
+        """
+        Return all metrics in the Prometheus text format.
+        """
+        return ''.join(metric.render() for metric in self.metrics)
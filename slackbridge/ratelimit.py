@@ -0,0 +1,141 @@
+import time
+
+
+class TokenBucket(object):
+    """
+    Allow ``rate`` requests per second on average, with bursts of up to
+    ``capacity`` requests.
+    """
+    def __init__(self, rate, capacity, clock=time.time):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def take(self):
+        """
+        Take a token. Returns 0 on success, or the number of seconds to
+        wait before trying again.
+        """
+        now = self.clock()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+    def pause(self, seconds):
+        """
+        The server told us to back off (HTTP 429 with Retry-After).
+        """
+        now = self.clock()
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 0.0
+        self.updated = self.paused_until
+
+
+class CircuitBreaker(object):
+    """
+    After ``threshold`` consecutive failures the breaker opens, and we
+    don't try at all for ``cooldown`` seconds. Then one try is allowed
+    (half-open): on success the breaker closes, on failure it opens
+    again for twice as long, up to ``max_cooldown``.
+    """
+    def __init__(self, threshold=5, cooldown=30.0, max_cooldown=600.0,
+                 clock=time.time):
+        self.threshold = threshold
+        self.base_cooldown = self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.clock = clock
+        self.failures = 0
+        self.open_until = 0.0
+
+    @property
+    def is_open(self):
+        return self.failures >= self.threshold
+
+    def wait(self):
+        """
+        Returns 0 if we may try now, or the seconds until we may.
+        """
+        if not self.is_open:
+            return 0.0
+        return max(0.0, self.open_until - self.clock())
+
+    def success(self):
+        self.failures = 0
+        self.cooldown = self.base_cooldown
+
+    def failure(self):
+        self.failures += 1
+        if self.failures == self.threshold:
+            self.open_until = self.clock() + self.cooldown
+        elif self.failures > self.threshold:
+            # Failed while half-open.
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+            self.open_until = self.clock() + self.cooldown
+
+
+class DestinationLimits(object):
+    """
+    Rate limit and circuit breaker for a single destination URL.
+    """
+    def __init__(self, rate, burst, threshold, cooldown, clock=time.time):
+        self.bucket = TokenBucket(rate, burst, clock=clock)
+        self.breaker = CircuitBreaker(threshold, cooldown, clock=clock)
+
+    def wait(self):
+        """
+        Returns 0 if we may send now (and takes a token), or the seconds
+        to wait before asking again.
+        """
+        wait = self.breaker.wait()
+        if wait:
+            return wait
+        return self.bucket.take()
+
+    def success(self):
+        self.breaker.success()
+
+    def failure(self):
+        self.breaker.failure()
+
+    def throttled(self, retry_after):
+        self.bucket.pause(retry_after)
+
+
+class RateLimiter(object):
+    """
+    DestinationLimits per URL, created on first use.
+    """
+    def __init__(self, rate=1.0, burst=3, threshold=5, cooldown=30.0,
+                 clock=time.time):
+        self.rate = rate
+        self.burst = burst
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self._limits = {}
+
+    def __getitem__(self, url):
+        try:
+            return self._limits[url]
+        except KeyError:
+            limits = self._limits[url] = DestinationLimits(
+                self.rate, self.burst, self.threshold, self.cooldown,
+                clock=self.clock)
+            return limits
+
+    def open_circuits(self):
+        return [url for url, limits in self._limits.items()
+                if limits.breaker.is_open]
@@ -0,0 +1,124 @@
+import heapq
+import random
+import time
+
+from collections import deque
+
+
+class RetryScheduler(object):
+    """
+    Delayed retries for failed deliveries, kept in a heap by due time.
+
+    Jobs are queued per destination. As soon as a job for a destination
+    fails, that destination is *blocked*: new jobs for it are deferred
+    (appended) behind the failed one, so messages keep their order. Other
+    destinations are not affected at all.
+
+    Every job must have a ``dest`` and a ``tries`` attribute.
+
+    Usage, from a single thread::
+
+        if scheduler.is_blocked(job.dest):
+            scheduler.defer(job)  # False if the destination is full
+        ...
+        for job in scheduler.pop_due():
+            if deliver(job):
+                scheduler.release(job.dest)
+            elif not scheduler.retry(job):
+                scheduler.release(job.dest)  # gave up
+
+    """
+    def __init__(self, max_tries=5, base_delay=1.0, max_delay=60.0,
+                 jitter=0.5, max_pending=100, clock=time.time):
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.max_pending = max_pending
+        self.clock = clock
+        self._heap = []   # (due, seq, dest)
+        self._seq = 0
+        self._queues = {}  # dest -> deque of jobs, head is (re)tried first
+
+    def __len__(self):
+        return sum(len(i) for i in self._queues.values())
+
+    def jobs(self):
+        for queue in self._queues.values():
+            for job in queue:
+                yield job
+
+    def backoff(self, tries):
+        """
+        Exponential backoff with jitter: about base * 2 ** (tries - 1),
+        capped at max_delay, minus up to ``jitter`` of that.
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** max(0, tries - 1))
+        return delay * (1.0 - self.jitter * random.random())
+
+    def _push(self, dest, due):
+        self._seq += 1
+        heapq.heappush(self._heap, (due, self._seq, dest))
+
+    def is_blocked(self, dest):
+        return dest in self._queues
+
+    def defer(self, job):
+        """
+        Queue job behind the jobs already waiting for job.dest. Returns
+        False if there are too many waiting already.
+        """
+        queue = self._queues[job.dest]
+        if len(queue) >= self.max_pending:
+            return False
+        queue.append(job)
+        return True
+
+    def retry(self, job):
+        """
+        Schedule a failed job for another try. Returns False if it has
+        used up all of its tries.
+        """
+        job.tries += 1
+        if job.tries >= self.max_tries:
+            return False
+        self.delay(job, self.backoff(job.tries))
+        return True
+
+    def delay(self, job, seconds):
+        """
+        Try job again after the given seconds, without using up a try.
+        Use this when we did not get to try at all (rate limiting).
+        """
+        self._queues.setdefault(job.dest, deque()).appendleft(job)
+        self._push(job.dest, self.clock() + seconds)
+
+    def release(self, dest):
+        """
+        The head job for dest is done (delivered or given up). Let the
+        next one in line go immediately, or unblock the destination.
+        """
+        queue = self._queues.get(dest)
+        if queue is None:
+            pass
+        elif queue:
+            self._push(dest, self.clock())
+        else:
+            del self._queues[dest]
+
+    def pop_due(self):
+        """
+        Yield the jobs whose time has come. The destination stays blocked
+        until you call release() or retry().
+        """
+        while self._heap and self._heap[0][0] <= self.clock():
+            due, seq, dest = heapq.heappop(self._heap)
+            yield self._queues[dest].popleft()
+
+    def timeout(self):
+        """
+        Seconds until the next job is due, or None if there are none.
+        """
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - self.clock())
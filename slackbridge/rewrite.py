@@ -0,0 +1,97 @@
+import re
+
+
+def _is_word(char):
+    # Like \w in a str regex.
+    return char.isalnum() or char == '_'
+
+
+class TextRewriter(object):
+    """
+    Rewrite outgoing webhook text for the other side in a single scan:
+
+    - "<@U9999ZZZZ>" becomes "@someuser" if we know that user;
+    - "<@U9999ZZZZ|someuser>" becomes "@someuser";
+    - "<#C03CYDD1R>" becomes "#somechan" if we know that channel;
+    - "@teamname" becomes "@channel" (case insensitive), if atchannel
+      (the teamname) is set.
+
+    All instances share one compiled regex, which matches any "@word";
+    whether that word starts with our teamname is checked in Python.
+    That keeps creating thousands of them (one per bridge) cheap.
+
+    Use for_atchannel() to get a shared instance.
+    """
+    REGEX = re.compile(
+        r'<@(?P<user>U[^>]+)>|<#(?P<channel>C[^>]+)>|'
+        r'(?<!\w)@(?P<word>[^\s<>&@]+)')
+    _instances = {}
+
+    def __init__(self, atchannel=None):
+        self.atchannel = atchannel.lower() if atchannel else None
+
+    def is_atchannel(self, word):
+        """
+        Return whether "@" + word starts with "@teamname\\b".
+        """
+        size = len(self.atchannel)
+        if word[:size].lower() != self.atchannel:
+            return False
+        if len(word) == size:
+            # Followed by a non-word character, or the end.
+            return _is_word(word[-1])
+        return _is_word(word[size - 1]) != _is_word(word[size])
+
+    @classmethod
+    def for_atchannel(cls, atchannel):
+        try:
+            return cls._instances[atchannel]
+        except KeyError:
+            instance = cls._instances[atchannel] = cls(atchannel)
+            return instance
+
+    def rewrite(self, text, users_list, channels_list):
+        def replace(match):
+            user_id, channel_id = match.group('user', 'channel')
+            if user_id:
+                # <@UABC|somename>, used in file uploads:
+                # 'text': '<@UABC|somename> uploaded a file: ...'
+                if '|' in user_id:
+                    return '@' + user_id.split('|', 1)[1]
+                # <@UABC>, used in other places:
+                # 'text': '<@UABC>: you forget that file sending fails'
+                try:
+                    return '@' + users_list[user_id].name
+                except KeyError:
+                    return match.group(0)  # untouched
+            if channel_id:
+                try:
+                    return '#' + channels_list[channel_id].name
+                except KeyError:
+                    return match.group(0)  # untouched
+            # @teamname => @channel
+            word = match.group('word')
+            if self.atchannel and self.is_atchannel(word):
+                return '@channel' + word[len(self.atchannel):]
+            return match.group(0)  # untouched
+
+        return self.REGEX.sub(replace, text)
+
+    @classmethod
+    def missing(cls, text, users_list, channels_list):
+        """
+        Return the sets of user and channel ids in text that rewrite()
+        cannot translate with these lists.
+        """
+        user_ids, channel_ids = set(), set()
+        if '<' not in text:
+            return user_ids, channel_ids
+        for match in cls.REGEX.finditer(text):
+            user_id, channel_id = match.group('user', 'channel')
+            if user_id:
+                if '|' not in user_id and user_id not in users_list:
+                    user_ids.add(user_id)
+            elif channel_id:
+                if '|' not in channel_id and channel_id not in channels_list:
+                    channel_ids.add(channel_id)
+        return user_ids, channel_ids
@@ -0,0 +1,101 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class SQLiteFile(object):
+    """
+    An SQLite database in WAL mode, so that many processes can read
+    while one writes. Each thread (and forked process) gets its own
+    connection. Subclasses set SCHEMA.
+    """
+    SCHEMA = None
+    ISOLATION_LEVEL = ''  # the sqlite3 default, a deferred transaction
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            # It contains info about your workspace; keep it private.
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(self.SCHEMA)
+
+    def _connection(self):
+        # sqlite3 connections may not cross threads or forks.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(
+                self.path, timeout=5.0, isolation_level=self.ISOLATION_LEVEL)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+
+class SnapshotStore(SQLiteFile):
+    """
+    Cache snapshots in an SQLite database (in WAL mode), shared by all
+    processes on this host and kept across restarts.
+
+    Each row holds the JSON-serialized value for (name, key), and the
+    time it was fetched from Slack.
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS snapshot (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            fetched REAL NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (name, key))
+    '''
+
+    @staticmethod
+    def _key(key):
+        return json.dumps(key)
+
+    def load(self, name, key):
+        """
+        Return (fetched, data), or None if there is no snapshot.
+        """
+        try:
+            row = self._connection().execute(
+                'SELECT fetched, data FROM snapshot '
+                'WHERE name = ? AND key = ?',
+                (name, self._key(key))).fetchone()
+        except sqlite3.Error as e:
+            log.error('Reading snapshot %s failed: %s', name, e)
+            return None
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def fetched(self, name, key):
+        """
+        Return when the snapshot was fetched, or None; cheap.
+        """
+        try:
+            row = self._connection().execute(
+                'SELECT fetched FROM snapshot WHERE name = ? AND key = ?',
+                (name, self._key(key))).fetchone()
+        except sqlite3.Error as e:
+            log.error('Reading snapshot %s failed: %s', name, e)
+            return None
+        return row and row[0]
+
+    def save(self, name, key, data, fetched=None):
+        try:
+            with self._connection() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO snapshot '
+                    '(name, key, fetched, data) VALUES (?, ?, ?, ?)',
+                    (name, self._key(key),
+                     (time.time() if fetched is None else fetched),
+                     json.dumps(data)))
+        except sqlite3.Error as e:
+            log.error('Writing snapshot %s failed: %s', name, e)
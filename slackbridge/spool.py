@@ -0,0 +1,289 @@
+import errno
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Spool(object):
+    """
+    Append-only on-disk journal of queued items, so they survive a
+    crashed or restarted worker.
+
+    The directory holds segment files named after the sequence number of
+    their first record, each record being one line: "<seq> <json>\\n".
+    A new segment is started when the current one exceeds segment_size.
+
+    The writer (front-end) calls append(). Writes go to the page cache
+    immediately; fsync is done at most every fsync_interval seconds, so
+    one fsync commits a whole group of appends (0 means fsync on every
+    append). The tail of a burst is synced by a timer, once the interval
+    has passed. A process crash loses nothing, an OS crash can lose up
+    to the last interval. append() may be called from many threads.
+
+    The reader (worker) calls replay() once on startup to get the items
+    that were never acknowledged, and ack(next_seq, unfinished) to say
+    that everything before next_seq is done except for the unfinished
+    ones. Acknowledged segments are removed (compaction).
+    Delivery is at-least-once: an item can be replayed if we crash
+    after handling it but before the ack.
+    """
+    ACK_FILE = 'ack'
+    SUFFIX = '.log'
+
+    def __init__(self, path, segment_size=(4 << 20), fsync_interval=0.1):
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # Writer state, opened on first append().
+        self._fd = None
+        self._size = 0
+        self._next_seq = None
+        self._synced = 0.0
+        self._unsynced = False
+        self._timer = None  # syncs the tail, see append()
+        self._lock = threading.Lock()
+        # Reader state.
+        self._acked = None
+        self._compacted = None
+
+    def __getstate__(self):
+        # For a (spawned) worker: it only reads.
+        state = dict(self.__dict__)
+        state.update(_fd=None, _timer=None, _lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _segments(self):
+        """
+        Return the sorted first sequence numbers of all segments.
+        """
+        return sorted(
+            int(i[:-len(self.SUFFIX)]) for i in os.listdir(self.path)
+            if i.endswith(self.SUFFIX) and i[:-len(self.SUFFIX)].isdigit())
+
+    def _segment_path(self, first_seq):
+        return os.path.join(
+            self.path, '{:020d}{}'.format(first_seq, self.SUFFIX))
+
+    @staticmethod
+    def _parse(line):
+        """
+        Return (seq, item), or None for a torn (partially written) line.
+        """
+        if not line.endswith(b'\n'):
+            return None
+        seq, data = line.split(b' ', 1)
+        return int(seq), json.loads(data.decode('utf-8'))
+
+    def _read_segment(self, first_seq):
+        with open(self._segment_path(first_seq), 'rb') as fp:
+            for line in fp:
+                try:
+                    record = self._parse(line)
+                except ValueError:
+                    record = None
+                if record is None:
+                    log.warning('Torn record in spool %s at seq>=%d',
+                                self.path, first_seq)
+                    return
+                yield record
+
+    # Writer side.
+
+    def _open_segment(self, first_seq):
+        if self._fd is not None:
+            os.fsync(self._fd)
+            os.close(self._fd)
+        path = self._segment_path(first_seq)
+        self._fd = os.open(
+            path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self._size = os.fstat(self._fd).st_size
+
+    def _open_writer(self):
+        segments = self._segments()
+        if not segments:
+            # Not through acked(): that cache is the reader's, and the
+            # workers are forked from us.
+            self._next_seq = self._read_acked()[0]
+            self._open_segment(self._next_seq)
+            return
+
+        # Find the last good record of the last segment, and cut off a
+        # torn record after it, if any.
+        last = segments[-1]
+        self._next_seq, good_size = last, 0
+        for seq, item in self._read_segment(last):
+            self._next_seq = seq + 1
+        with open(self._segment_path(last), 'rb') as fp:
+            for line in fp:
+                if not line.endswith(b'\n'):
+                    break
+                good_size += len(line)
+        self._open_segment(last)
+        if self._size != good_size:
+            os.ftruncate(self._fd, good_size)
+            self._size = good_size
+
+    def append(self, item):
+        """
+        Write item to the journal and return its sequence number.
+        """
+        record = json.dumps(item)
+        with self._lock:
+            if self._fd is None:
+                self._open_writer()
+            elif self._size >= self.segment_size:
+                self._open_segment(self._next_seq)
+
+            seq = self._next_seq
+            data = '{} {}\n'.format(seq, record).encode('utf-8')
+            os.write(self._fd, data)
+            self._size += len(data)
+            self._next_seq += 1
+
+            now = time.time()
+            if now - self._synced >= self.fsync_interval:
+                self._sync(now)
+            else:
+                self._unsynced = True
+                if self._timer is None:
+                    self._timer = threading.Timer(
+                        self._synced + self.fsync_interval - now,
+                        self._sync_tail)
+                    self._timer.daemon = True
+                    self._timer.start()
+        return seq
+
+    def _sync(self, now):
+        os.fsync(self._fd)
+        self._synced = now
+        self._unsynced = False
+
+    def _sync_tail(self):
+        # From the timer: nothing was appended since the last records.
+        with self._lock:
+            self._timer = None
+            if self._fd is not None and self._unsynced:
+                self._sync(time.time())
+
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._fd is not None:
+                os.fsync(self._fd)
+                os.close(self._fd)
+                self._fd = None
+
+    # Reader side.
+
+    def acked(self):
+        """
+        Return (next_seq, unfinished): everything before next_seq is
+        done, except the sequence numbers in unfinished.
+        """
+        if self._acked is None:
+            self._acked = self._read_acked()
+        return self._acked
+
+    def _read_acked(self):
+        try:
+            with open(os.path.join(self.path, self.ACK_FILE)) as fp:
+                seqs = [int(i) for i in fp.read().split()]
+        except (IOError, OSError, ValueError):
+            seqs = []
+        return (seqs[0], frozenset(seqs[1:])) if seqs else (0, frozenset())
+
+    def low_water_mark(self):
+        next_seq, unfinished = self.acked()
+        return min(unfinished) if unfinished else next_seq
+
+    def replay(self):
+        """
+        Return an iterator of (seq, item) for all items that were not
+        acknowledged. Call this first in a new worker: it reads the ack
+        file again, as a previous worker may have moved it on since.
+        """
+        self._acked = self._compacted = None
+        return self._replay(*self.acked())
+
+    def _replay(self, next_seq, unfinished):
+        low = self.low_water_mark()
+        segments = self._segments()
+        for idx, first_seq in enumerate(segments):
+            if idx + 1 < len(segments) and segments[idx + 1] <= low:
+                continue  # fully acknowledged, compaction will remove it
+            for seq, item in self._read_segment(first_seq):
+                if seq >= next_seq or seq in unfinished:
+                    yield seq, item
+
+    def ack(self, next_seq, unfinished=()):
+        """
+        Everything before next_seq is done, except for the (few) items
+        in unfinished, which are still held or waiting for a retry.
+        """
+        acked = (next_seq, frozenset(unfinished))
+        if acked == self.acked():
+            return
+        path = os.path.join(self.path, self.ACK_FILE)
+        with open(path + '.tmp', 'w') as fp:
+            fp.write(' '.join(str(i) for i in (
+                [next_seq] + sorted(acked[1]))) + '\n')
+        os.rename(path + '.tmp', path)
+        self._acked = acked
+        low = self.low_water_mark()
+        if self._compacted is None or low - self._compacted >= 1000:
+            self.compact()
+
+    def compact(self):
+        """
+        Remove the segments that only hold acknowledged items. The last
+        segment is never removed: the writer may still be using it.
+        """
+        low = self.low_water_mark()
+        segments = self._segments()
+        for first_seq, next_seq in zip(segments, segments[1:]):
+            if next_seq > low:
+                break
+            try:
+                os.unlink(self._segment_path(first_seq))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        self._compacted = low
+
+
+def lock_slot(base_path):
+    """
+    Every front-end process needs its own set of spools. Find the first
+    numbered directory below base_path that no other (living) process
+    holds, lock it, and return its path. The lock is held until this
+    process and its children are gone.
+    """
+    slot = 0
+    while True:
+        path = os.path.join(base_path, str(slot))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        fd = os.open(
+            os.path.join(path, 'lock'), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            os.close(fd)
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            slot += 1
+        else:
+            return path  # fd is left open on purpose
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import logging
+import socket
+import sys
+
+from urllib.parse import urlencode
+
+log = logging.getLogger(__name__)
+
+UNSET = '<unset>'
+
+
+class User(object):
+    """
+    The part of a users.list member that we use. Slotted and with
+    interned strings, because there can be a hundred thousand of them.
+    """
+    __slots__ = ('id', 'name', 'image_32')
+
+    def __init__(self, id, name, image_32=None):
+        self.id = id
+        self.name = name
+        self.image_32 = image_32
+
+    @classmethod
+    def from_json(cls, member):
+        return cls(
+            sys.intern(member.get('id', '')),
+            sys.intern(member.get('name', UNSET)),
+            member.get('profile', {}).get('image_32'))
+
+    def __repr__(self):
+        return '<User {} @{}>'.format(self.id, self.name)
+
+
+class Channel(object):
+    __slots__ = ('id', 'name')
+
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+    @classmethod
+    def from_json(cls, channel):
+        return cls(
+            sys.intern(channel.get('id', '')),
+            sys.intern(channel.get('name', UNSET)))
+
+    def __repr__(self):
+        return '<Channel {} #{}>'.format(self.id, self.name)
+
+
+class ChannelList(dict):
+    """
+    Channels by id, with an index by name.
+    """
+    def __init__(self):
+        super(ChannelList, self).__init__()
+        self.by_name = {}
+
+    def add(self, channel):
+        self[channel.id] = channel
+        self.by_name[channel.name] = channel
+
+    def find(self, name_or_id):
+        """
+        Look up 'C9999ZZZZ', 'general' or '#general'.
+        """
+        if name_or_id[0:1] == '#':
+            return self.by_name.get(name_or_id[1:])
+        return self.get(name_or_id) or self.by_name.get(name_or_id)
+
+
+def dump_users(users):
+    return [[i.id, i.name, i.image_32] for i in users.values()]
+
+
+def load_users(data):
+    users = {}
+    for id_, name, image_32 in data:
+        users[sys.intern(id_)] = User(sys.intern(id_), sys.intern(name),
+                                      image_32)
+    return users
+
+
+def dump_channels(channels):
+    return [[i.id, i.name] for i in channels.values()]
+
+
+def load_channels(data):
+    channels = ChannelList()
+    for id_, name in data:
+        channels.add(Channel(sys.intern(id_), sys.intern(name)))
+    return channels
+
+
+def workspace_key(wa_token):
+    """
+    Return a cache key for the workspace of this Web API token. Many
+    bridges share the token of one workspace; they share its lists too.
+    The token itself is not used, so it does not end up in logs or
+    snapshots.
+    """
+    return 'ws-' + hashlib.sha256(wa_token.encode('utf-8')).hexdigest()[:16]
+
+
+class WebApiError(ValueError):
+    pass
+
+
+class WebApi(object):
+    """
+    Minimal Slack Web API client on top of a ConnectionPool.
+
+    All list calls follow ``response_metadata.next_cursor``, and parse
+    and convert one page at a time, so we never hold the JSON of the
+    whole workspace in memory.
+
+    If a metrics Counter is passed as ``timeouts``, every call that
+    times out counts, labeled with its method.
+    """
+    def __init__(self, http, base_url='https://slack.com/api/',
+                 timeouts=None):
+        self.http = http
+        self.base_url = base_url
+        self.timeouts = timeouts
+
+    def call(self, method, wa_token, **params):
+        params['token'] = wa_token
+        url = '{}{}?{}'.format(self.base_url, method, urlencode(params))
+        log.info('Fetching %s...', method)
+        try:
+            response = self.http.urlopen(url)
+        except socket.timeout:
+            if self.timeouts:
+                self.timeouts.inc(method)
+            raise
+        except Exception as e:
+            if hasattr(e, 'fp'):
+                log.info('Got data: %r', e.fp.read())
+            raise
+        data = response.read()
+        data = data.decode('utf-8', 'replace')
+        log.debug('Got %s data: %r', method, data)
+        data = json.loads(data)
+        if not data.get('ok'):
+            raise WebApiError('{}: {}'.format(method, data.get('error')))
+        return data
+
+    def pages(self, method, wa_token, **params):
+        """
+        Yield each page of a cursor-paginated method.
+        """
+        while True:
+            data = self.call(method, wa_token, **params)
+            yield data
+            cursor = data.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+            params['cursor'] = cursor
+
+    def users_list(self, wa_token):
+        users = {}
+        for page in self.pages('users.list', wa_token, limit=200):
+            for member in page.get('members', ()):
+                # (don't load deleted users)
+                if not member.get('deleted', False):
+                    user = User.from_json(member)
+                    users[user.id] = user
+        return users
+
+    def channels_list(self, wa_token):
+        channels = ChannelList()
+        for page in self.pages(
+                'conversations.list', wa_token,
+                exclude_archived=1, limit=1000):
+            for channel in page.get('channels', ()):
+                channels.add(Channel.from_json(channel))
+        return channels
+
+    def channel_members(self, wa_token, channel_id):
+        """
+        Return the user ids of the members of a single channel.
+        """
+        members = []
+        for page in self.pages(
+                'conversations.members', wa_token,
+                channel=channel_id, limit=1000):
+            members.extend(sys.intern(i) for i in page.get('members', ()))
+        return tuple(members)
+
+    def user_info(self, wa_token, user_id):
+        member = self.call('users.info', wa_token, user=user_id)['user']
+        if member.get('deleted', False):
+            # (like users_list)
+            raise WebApiError('users.info: deleted')
+        return User.from_json(member)
+
+    def channel_info(self, wa_token, channel_id):
+        return Channel.from_json(self.call(
+            'conversations.info', wa_token, channel=channel_id)['channel'])
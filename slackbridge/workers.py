@@ -0,0 +1,290 @@
+import logging
+import os
+import select
+import signal
+import threading
+import time
+import zlib
+
+from multiprocessing import Pipe, Value
+
+from .spool import Spool, lock_slot
+
+log = logging.getLogger(__name__)
+
+# A worker that is waiting for items beats at least this often.
+HEARTBEAT_INTERVAL = 1.0
+
+
+class ShardStats(object):
+    """
+    Counters shared between the front-end and a single response worker.
+
+    The front-end increments ``depth`` when it sends an item, the worker
+    decrements it when it picks the item up. ``busy`` is the total
+    number of seconds the worker spent handling items. ``heartbeat`` is
+    the last time the worker was seen alive.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.depth = Value('l', 0)
+        self.handled = Value('l', 0)
+        self.busy = Value('d', 0.0)
+        self.heartbeat = Value('d', 0.0)
+
+    def beat(self):
+        self.heartbeat.value = time.time()
+
+    def picked_up(self):
+        with self.depth.get_lock():
+            self.depth.value -= 1
+
+    def done(self, seconds):
+        with self.handled.get_lock():
+            self.handled.value += 1
+        self.busy_for(seconds)
+
+    def busy_for(self, seconds):
+        with self.busy.get_lock():
+            self.busy.value += seconds
+
+    def __str__(self):
+        return 'shard {}: depth {}, handled {}, busy {:.3f}s'.format(
+            self.index, self.depth.value, self.handled.value,
+            self.busy.value)
+
+
+class Shard(object):
+    def __init__(self, index, spool=None):
+        self.stats = ShardStats(index)
+        self.spool = spool
+        # For some reason, using a Queue() did not work at all as soon
+        # as this was started from uWSGI. In buildin_httpd mode it
+        # worked fine. But in uWSGI the Queue seemed to buffer outgoing
+        # messages.
+        self.parent_pipe, self.child_pipe = Pipe()
+        # Senders (front-end threads) take turns, per shard: one waiting
+        # for a full pipe does not hold up the other shards.
+        self._lock = threading.Lock()
+        self.process = None
+        # Supervision, see ShardedQueue.supervise().
+        self.started = 0.0
+        self.restarts = 0
+        self.failures = 0  # restarts in a row, for the backoff
+        self.next_start = 0.0
+
+    def send(self, item, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        if timeout is None:
+            self._lock.acquire()
+        elif not self._lock.acquire(timeout=timeout):
+            raise TimeoutError(
+                'worker {} is not taking items'.format(self.stats.index))
+        try:
+            if deadline is not None:
+                # Refuse, rather than block on a full pipe if the worker
+                # does not keep up (or hangs, until it is restarted).
+                writable = select.select(
+                    [], [self.parent_pipe.fileno()], [],
+                    max(0, deadline - time.time()))[1]
+                if not writable:
+                    raise TimeoutError('worker {} is not taking items'.format(
+                        self.stats.index))
+            if self.spool and isinstance(item, dict):
+                # Journal it first; the worker gets the sequence number
+                # so it can acknowledge it.
+                item = (self.spool.append(item), item)
+            with self.stats.depth.get_lock():
+                self.stats.depth.value += 1
+            self.parent_pipe.send(item)
+        finally:
+            self._lock.release()
+
+
+class ShardedQueue(object):
+    """
+    Distribute outgoing webhook items over a fixed set of worker pipes.
+
+    Items for the same outgoing webhook token (that is: the same bridged
+    channel) always end up at the same worker, so their order is kept.
+    Anything else (strings, None) is broadcast to all workers that take
+    it within send_timeout.
+
+    If spool_path is set, every item is journaled to disk (see Spool)
+    before it is sent.
+
+    Once started, the workers are supervised (on every send(), and
+    every supervise_interval seconds from a thread): a worker that died,
+    or that did not beat for hang_timeout seconds, is (killed and)
+    started again, after a backoff if it keeps dying. The pipe is kept,
+    so the new worker gets the items that were still queued. The item
+    the old worker was handling is lost, unless the spool is used.
+
+    If a worker cannot take an item within send_timeout seconds, send()
+    raises TimeoutError. send() may be called from many threads at once.
+    """
+    def __init__(self, count, spool_path=None, fsync_interval=0.1,
+                 hang_timeout=120.0, backoff=1.0, max_backoff=60.0,
+                 send_timeout=None, supervise_interval=HEARTBEAT_INTERVAL):
+        self.hang_timeout = hang_timeout
+        self.send_timeout = send_timeout
+        self.supervise_interval = supervise_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._spawn = self._pid = None
+        self._stopping = False
+        self._stopped = threading.Event()  # ends the supervisor thread
+        self._supervising = threading.Lock()
+        count = max(1, count)
+        if spool_path:
+            slot = lock_slot(spool_path)
+            self.shards = [
+                Shard(i, Spool(os.path.join(slot, 'shard-{}'.format(i)),
+                               fsync_interval=fsync_interval))
+                for i in range(count)]
+        else:
+            self.shards = [Shard(i) for i in range(count)]
+
+    def __len__(self):
+        return len(self.shards)
+
+    @staticmethod
+    def shard_key(item):
+        return item.get('token') or item.get('channel_id') or ''
+
+    @classmethod
+    def shard_index(cls, item, count):
+        # Use a stable hash; hash() of str is salted per process.
+        return zlib.crc32(cls.shard_key(item).encode('utf-8')) % count
+
+    def shard_for(self, item):
+        return self.shards[self.shard_index(item, len(self.shards))]
+
+    def start(self, spawn):
+        """
+        Start a worker for every shard; spawn(shard) must start and
+        return a process for it.
+        """
+        self._spawn, self._pid = spawn, os.getpid()
+        for shard in self.shards:
+            self._start(shard)
+        # Also when no items come in: the retries held by a worker that
+        # died should not wait for the next message.
+        thread = threading.Thread(
+            target=self._supervise_forever, name='supervisor')
+        thread.daemon = True
+        thread.start()
+
+    def _supervise_forever(self):
+        while not self._stopped.wait(self.supervise_interval):
+            self.supervise()
+
+    def _start(self, shard):
+        shard.stats.beat()  # give it hang_timeout to get going
+        shard.started = time.time()
+        shard.process = self._spawn(shard)
+
+    def supervise(self):
+        """
+        Restart the workers that died or hang. Cheap enough to call for
+        every item. If another thread is at it already, this returns
+        right away.
+        """
+        if self._stopping or self._pid != os.getpid():
+            return  # only the parent can wait for its children
+        if not self._supervising.acquire(False):
+            return
+        try:
+            self._supervise()
+        finally:
+            self._supervising.release()
+
+    def _supervise(self):
+        now = time.time()
+        for shard in self.shards:
+            if shard.process.is_alive():
+                if now - shard.stats.heartbeat.value < self.hang_timeout:
+                    continue
+                log.error('Worker %d did not beat for %.0fs, killing it',
+                          shard.stats.index, now - shard.stats.heartbeat.value)
+                self._kill(shard)
+            if now < shard.next_start:
+                continue  # backing off
+
+            if now - shard.started > self.max_backoff:
+                shard.failures = 0  # it ran fine for a while
+            delay = min(self.max_backoff, self.backoff * 2 ** shard.failures)
+            log.error('Worker %d stopped (exit code %s), restarting it; '
+                      'next restart not before %.0fs',
+                      shard.stats.index, shard.process.exitcode, delay)
+            shard.failures += 1
+            shard.restarts += 1
+            shard.next_start = now + delay
+            self._start(shard)
+
+    @staticmethod
+    def _kill(shard):
+        shard.process.terminate()
+        shard.process.join(1)
+        if shard.process.is_alive():
+            os.kill(shard.process.pid, signal.SIGKILL)
+            shard.process.join()
+
+    def stop(self):
+        if self._stopping:
+            return  # e.g. from both the ASGI shutdown and uwsgi.atexit
+        self._stopping = True
+        self._stopped.set()
+        stopping = self._broadcast(None)
+        for shard in self.shards:
+            if shard in stopping:
+                # Give it time to flush what it holds.
+                shard.process.join(self.hang_timeout)
+            if shard.process.is_alive():
+                log.error('Worker %d does not stop, killing it',
+                          shard.stats.index)
+                self._kill(shard)
+
+    def health(self):
+        """
+        Return a list with liveness and lag info for every worker. This
+        only looks at the shared counters; nothing is sent.
+        """
+        now = time.time()
+        result = []
+        for shard in self.shards:
+            age = now - shard.stats.heartbeat.value
+            alive = age < self.hang_timeout and (
+                # Only the parent can see whether it exited.
+                self._pid != os.getpid() or shard.process.is_alive())
+            result.append({
+                'shard': shard.stats.index,
+                'alive': alive,
+                'heartbeat_age': round(age, 3),
+                'depth': shard.stats.depth.value,
+                'restarts': shard.restarts,
+            })
+        return result
+
+    def send(self, item):
+        self.supervise()
+        if isinstance(item, dict):
+            self.shard_for(item).send(item, timeout=self.send_timeout)
+        else:
+            self._broadcast(item)
+
+    def _broadcast(self, item):
+        # Skip the workers that are not taking items; the supervisor
+        # restarts them if they hang. Returns the shards that got it.
+        sent = []
+        for shard in self.shards:
+            try:
+                shard.send(item, timeout=self.send_timeout)
+            except TimeoutError as e:
+                log.warning('Not sending %r: %s', item, e)
+            else:
+                sent.append(shard)
+        return sent
+
+    def stats(self):
+        return [shard.stats for shard in self.shards]
@@ -0,0 +1,97 @@
+import unittest
+
+from slackbridge.ratelimit import CircuitBreaker, RateLimiter, TokenBucket
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.bucket = TokenBucket(rate=1, capacity=3, clock=self.clock)
+
+    def test_burst_then_rate(self):
+        self.assertEqual([self.bucket.take() for i in range(3)], [0, 0, 0])
+        self.assertEqual(self.bucket.take(), 1.0)
+        self.clock.now += 0.5
+        self.assertEqual(self.bucket.take(), 0.5)
+        self.clock.now += 0.5
+        self.assertEqual(self.bucket.take(), 0)
+
+    def test_retry_after_pause(self):
+        # HTTP 429 with Retry-After: 10.
+        self.bucket.pause(10)
+        self.assertEqual(self.bucket.take(), 10)
+        self.clock.now += 4
+        self.assertEqual(self.bucket.take(), 6)
+        # A shorter pause does not cut it short.
+        self.bucket.pause(1)
+        self.assertEqual(self.bucket.take(), 6)
+
+        # After the pause, no burst: the bucket fills up from empty.
+        self.clock.now += 6
+        self.assertEqual(self.bucket.take(), 1.0)
+        self.clock.now += 1
+        self.assertEqual(self.bucket.take(), 0)
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(
+            threshold=3, cooldown=10, max_cooldown=30, clock=self.clock)
+
+    def test_open_half_open_closed(self):
+        for i in range(2):
+            self.breaker.failure()
+            self.assertEqual(self.breaker.wait(), 0)
+        self.breaker.failure()
+        self.assertTrue(self.breaker.is_open)
+        self.assertEqual(self.breaker.wait(), 10)
+
+        # Half-open: one try; it fails, so twice as long.
+        self.clock.now += 10
+        self.assertEqual(self.breaker.wait(), 0)
+        self.breaker.failure()
+        self.assertEqual(self.breaker.wait(), 20)
+        self.clock.now += 20
+        self.breaker.failure()
+        self.assertEqual(self.breaker.wait(), 30)  # max_cooldown
+
+        # Half-open again; it works, so it closes and starts over.
+        self.clock.now += 30
+        self.assertEqual(self.breaker.wait(), 0)
+        self.breaker.success()
+        self.assertFalse(self.breaker.is_open)
+        self.assertEqual(self.breaker.wait(), 0)
+        for i in range(3):
+            self.breaker.failure()
+        self.assertEqual(self.breaker.wait(), 10)
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def test_per_destination(self):
+        clock = FakeClock()
+        limiter = RateLimiter(
+            rate=1, burst=1, threshold=1, cooldown=5, clock=clock)
+        self.assertEqual(limiter['a'].wait(), 0)
+        self.assertEqual(limiter['a'].wait(), 1.0)
+        self.assertEqual(limiter['b'].wait(), 0)
+
+        limiter['b'].failure()
+        self.assertEqual(limiter.open_circuits(), ['b'])
+        self.assertEqual(limiter['b'].wait(), 5)
+        limiter['a'].throttled(30)
+        clock.now += 5
+        self.assertEqual(limiter['a'].wait(), 25)
+        self.assertEqual(limiter['b'].wait(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
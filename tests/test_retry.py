@@ -0,0 +1,78 @@
+import unittest
+
+from slackbridge.retry import RetryScheduler
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Job(object):
+    def __init__(self, dest, name):
+        self.dest = dest
+        self.name = name
+        self.tries = 0
+
+
+class RetrySchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.retries = RetryScheduler(
+            base_delay=1.0, jitter=0, max_pending=3, clock=self.clock)
+
+    def due(self):
+        return [i.name for i in self.retries.pop_due()]
+
+    def test_order_per_destination(self):
+        a1, a2, a3 = Job('a', 'a1'), Job('a', 'a2'), Job('a', 'a3')
+        self.assertFalse(self.retries.is_blocked('a'))
+        self.assertTrue(self.retries.retry(a1))  # a1 failed
+        self.assertTrue(self.retries.is_blocked('a'))
+        self.assertTrue(self.retries.defer(a2))
+        self.assertFalse(self.retries.is_blocked('b'))  # unaffected
+        self.assertEqual(self.retries.timeout(), 1.0)
+        self.assertEqual(self.due(), [])
+
+        # a1 is throttled when it is due: it stays at the head.
+        self.clock.now += 1
+        self.assertEqual(self.due(), ['a1'])
+        self.retries.delay(a1, 5)
+        self.assertTrue(self.retries.defer(a3))
+        self.assertFalse(self.retries.defer(Job('a', 'a4')))  # full
+        self.clock.now += 4
+        self.assertEqual(self.due(), [])
+        self.clock.now += 1
+        self.assertEqual(self.due(), ['a1'])
+
+        # Delivered: the next in line goes right away, in order.
+        self.retries.release('a')
+        self.assertEqual(self.due(), ['a2'])
+        self.retries.release('a')
+        self.assertEqual(self.due(), ['a3'])
+        self.retries.release('a')
+        self.assertFalse(self.retries.is_blocked('a'))
+        self.assertEqual(len(self.retries), 0)
+        self.assertIsNone(self.retries.timeout())
+
+    def test_gives_up(self):
+        job = Job('a', 'a1')
+        for i in range(self.retries.max_tries - 1):
+            self.assertTrue(self.retries.retry(job))
+            self.clock.now += 60
+            self.assertEqual(self.due(), ['a1'])
+        self.assertFalse(self.retries.retry(job))
+        self.retries.release('a')
+        self.assertFalse(self.retries.is_blocked('a'))
+
+    def test_backoff(self):
+        self.assertEqual(
+            [self.retries.backoff(i) for i in range(1, 9)],
+            [1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 60.0, 60.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import copy
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import unittest
+
+from unittest import mock
+
+from slackbridge.spool import Spool
+
+
+class SpoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def spool(self, fsync_interval=0):
+        spool = Spool(self.path, fsync_interval=fsync_interval)
+        self.addCleanup(spool.close)
+        return spool
+
+    @staticmethod
+    def fork(spool):
+        # A worker gets a copy of the front-end's spool object.
+        return copy.copy(spool)
+
+    def test_replay_unacked(self):
+        spool = self.spool()
+        seqs = [spool.append({'text': str(i)}) for i in range(5)]
+        self.assertEqual(seqs, [0, 1, 2, 3, 4])
+
+        worker = self.fork(spool)
+        self.assertEqual(
+            [(seq, item['text']) for seq, item in worker.replay()],
+            [(0, '0'), (1, '1'), (2, '2'), (3, '3'), (4, '4')])
+        worker.ack(5, [3])
+
+        worker = self.fork(spool)
+        self.assertEqual([seq for seq, item in worker.replay()], [3])
+
+    def test_restarted_worker_rereads_acks(self):
+        # The front-end's first append must not leave a stale ack
+        # state behind for the workers forked from it later.
+        spool = self.spool()
+        for i in range(5):
+            spool.append({'text': str(i)})
+        worker = self.fork(spool)
+        self.assertEqual(len(list(worker.replay())), 5)
+        worker.ack(5)
+
+        # The worker is killed and restarted; one more item came in.
+        spool.append({'text': '5'})
+        worker = self.fork(spool)
+        replay = worker.replay()
+        self.assertEqual(worker.acked(), (5, frozenset()))
+        self.assertEqual(
+            [(seq, item['text']) for seq, item in replay], [(5, '5')])
+
+    def test_writer_continues_after_acks(self):
+        spool = self.spool()
+        for i in range(3):
+            spool.append({'text': str(i)})
+        spool.ack(3)
+        spool.close()
+        for name in os.listdir(self.path):
+            if name.endswith(Spool.SUFFIX):
+                os.unlink(os.path.join(self.path, name))
+
+        # A new front-end starts numbering after the acknowledged ones.
+        spool = self.spool()
+        self.assertEqual(spool.append({'text': '3'}), 3)
+
+    def test_torn_record(self):
+        spool = self.spool()
+        spool.append({'text': '0'})
+        spool.close()
+        with open(os.path.join(self.path, '{:020d}{}'.format(
+                0, Spool.SUFFIX)), 'ab') as fp:
+            fp.write(b'1 {"te')
+
+        spool = self.spool()
+        self.assertEqual(spool.append({'text': '1'}), 1)
+        self.assertEqual(
+            [(seq, item['text']) for seq, item in spool.replay()],
+            [(0, '0'), (1, '1')])
+
+    def test_tail_synced_without_append(self):
+        spool = self.spool(fsync_interval=0.05)
+        with mock.patch('os.fsync', wraps=os.fsync) as fsync:
+            spool.append({'text': '0'})  # synced right away
+            spool.append({'text': '1'})  # within the interval
+            self.assertEqual(fsync.call_count, 1)
+            # Nothing more comes in; the tail is synced all the same.
+            time.sleep(0.2)
+            self.assertEqual(fsync.call_count, 2)
+            self.assertFalse(spool._unsynced)
+
+    def test_pickled_for_reader(self):
+        spool = self.spool(fsync_interval=10)
+        spool.append({'text': '0'})
+        spool.append({'text': '1'})
+        worker = pickle.loads(pickle.dumps(spool))
+        self.assertEqual([seq for seq, item in worker.replay()], [0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
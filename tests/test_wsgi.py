@@ -0,0 +1,103 @@
+import json
+import os
+import unittest
+
+from urllib.error import HTTPError
+from urllib.parse import parse_qs
+
+# No bridges; the tests make their own routes.
+os.environ.setdefault('SLACKBRIDGE_INIFILE', os.devnull)
+
+import wsgi  # noqa
+from slackbridge.config.routing import Route  # noqa
+from slackbridge.ratelimit import RateLimiter  # noqa
+from slackbridge.retry import RetryScheduler  # noqa
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeResponse(object):
+    def read(self):
+        return b'ok'
+
+
+class FakeHttp(object):
+    def __init__(self):
+        self.posts = []
+        self.errors = []  # raised by the next posts
+
+    def urlopen(self, url, data, deadline=None):
+        self.posts.append((url, data))
+        if self.errors:
+            raise self.errors.pop(0)
+        return FakeResponse()
+
+
+class ResponseHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.route = Route(
+            'tokA', 'tokB', 'https://hooks.example.com/services/B',
+            'https://hooks.example.com/services/A', 'C000001', 'peerA')
+        self.handler = wsgi.ResponseHandler(
+            {'tokA': self.route}, wsgi.log)
+        self.handler.http = FakeHttp()
+        self.handler.limits = RateLimiter(rate=1, burst=3, clock=self.clock)
+        self.handler.retries = RetryScheduler(clock=self.clock)
+
+    def posted(self):
+        return [
+            (url, json.loads(parse_qs(data.decode('utf-8'))['payload'][0]))
+            for url, data in self.handler.http.posts]
+
+    def test_non_text_notice_held_for_rate_limit(self):
+        # Use up the burst on our own (reply) webhook.
+        for i in range(3):
+            self.handler.limits[self.route.reply_url].wait()
+        self.handler.respond({
+            'user_id': 'U000001', 'user_name': 'alice', 'token': 'tokA',
+            'channel_name': 'shared', 'text': ''})
+        self.assertEqual(
+            [(url, p['channel']) for url, p in self.posted()],
+            [(self.route.peer_url, 'C000001')])
+
+        # The held local notice still goes to the local channel.
+        self.clock.now += 5
+        self.handler.run_due()
+        self.assertEqual(
+            [(url, p['channel']) for url, p in self.posted()[1:]],
+            [(self.route.reply_url, '#shared')])
+
+    def test_retry_after(self):
+        self.handler.http.errors.append(HTTPError(
+            self.route.peer_url, 429, 'Too Many Requests',
+            {'Retry-After': '7'}, None))
+        for text in ('one', 'two'):
+            self.handler.respond({
+                'user_id': 'U000001', 'user_name': 'alice', 'token': 'tokA',
+                'channel_name': 'shared', 'text': text})
+        self.assertEqual(len(self.posted()), 1)
+        self.assertEqual(self.handler.due_timeout(), 7)
+
+        # Nothing is posted until Slack said we could.
+        self.clock.now += 6
+        self.handler.run_due()
+        self.assertEqual(len(self.posted()), 1)
+        # Then at the rate limit, starting from an empty bucket; in
+        # order.
+        for i in range(3):
+            self.clock.now += 1
+            self.handler.run_due()
+        self.assertEqual(
+            [p['text'] for url, p in self.posted()], ['one', 'one', 'two'])
+        self.assertEqual(len(self.handler.retries), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,37 +14,55 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-import cgi
 import datetime
 import json
 import logging
-import re
+import os
 import signal
 import smtplib
+import socket
+import sys
 import time
+import threading
 import traceback
 
-try:
-    from urllib import request
-except ImportError:
-    import urllib2 as request  # python2
-try:
-    from urllib import parse
-except ImportError:
-    import urllib as parse  # python2
-
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
 from email.header import Header
 from email.mime.text import MIMEText
-from multiprocessing import Process, Pipe
+from multiprocessing import Process
 from pprint import pformat
-
+from urllib import parse
+
+from slackbridge.alerts import Alerter
+from slackbridge.asgi import AsgiFrontend
+from slackbridge.backfill import Backfill
+from slackbridge.body import BadRequest, parse_body
+from slackbridge.cache import TTLCache
+from slackbridge.coalesce import Coalescer
 from slackbridge.config import auto
+from slackbridge.config.routing import routes_from_config_dict
+from slackbridge.dedup import Deduplicator
+from slackbridge.dispatcher import DispatcherClient, DispatcherServer
+from slackbridge.httpclient import ConnectionPool
+from slackbridge.lane import Lane
+from slackbridge.metrics import Counter as MetricCounter
+from slackbridge.metrics import Gauge, Histogram, Registry
+from slackbridge.ratelimit import RateLimiter
+from slackbridge.retry import RetryScheduler
+from slackbridge.rewrite import TextRewriter
+from slackbridge.snapshot import SnapshotStore
+from slackbridge.webapi import (
+    UNSET, ChannelList, WebApi, dump_channels, dump_users, load_channels,
+    load_users, workspace_key)
+from slackbridge.workers import HEARTBEAT_INTERVAL, ShardedQueue
 
 # BASE_PATH needs to be set to the path prefix (location) as configured
 # in the web server.
 BASE_PATH = '/'
 
 # Load CONFIG: autodetect which kind of config we use.
+ROUTES = None
 try:
     bridgeconfigs = auto.load()
 except StopIteration:
@@ -56,12 +74,19 @@ else:
     # a dictionary with payload updates ({'channel': '#new_chan'}).
     # NOTE: This is about to change. Expect the CONFIG dict to be removed.
     CONFIG = bridgeconfigs.to_config_dict()
+    # ROUTES is the same, compiled for fast lookups. Use this.
+    ROUTES = bridgeconfigs.to_routing_table()
 
 # Lazy initialization of workers?
 LAZY_INITIALIZATION = True  # use, unless you have uwsgi-lazy-apps
 # Notification settings (mail_admins) in case of broken connections.
 MAIL_FROM = 'noreply@slackbridge.example.com'
 MAIL_TO = ('root',)  # a tuple
+# Errors are mailed as digests, grouped by kind and destination: the
+# first ALERT_DELAY seconds after the first error, then at most one
+# mail every ALERT_INTERVAL seconds (per process).
+ALERT_DELAY = 10
+ALERT_INTERVAL = 300
 
 # Or, you can put the config (and logging defaults) in a separate file.
 try:
@@ -69,18 +94,182 @@ try:
         BASE_PATH, CONFIG, LAZY_INITIALIZATION, MAIL_FROM, MAIL_TO)
 except ImportError:
     pass
+else:
+    ROUTES = routes_from_config_dict(CONFIG)
 
-# Globals initialized once below.
+# Optional tunables. These may be set in slackbridgeconf as well, but
+# need not be.
+#
+# Number of response workers (subprocesses). Messages for the same
+# bridged channel are always handled by the same worker, so they stay
+# in order.
+RESPONSE_WORKERS = 1
+# Seconds to keep the users.list and channels.list results. After that,
+# the old list is used while a new one is fetched in the background. A
+# failed fetch is retried after CACHE_NEGATIVE_TTL seconds.
+CACHE_TTL = 3600
+CACHE_NEGATIVE_TTL = 60
+# SQLite file to keep the users and channels lists in, shared by all
+# processes on this host and kept across restarts. A restarted worker
+# can then use the (possibly stale) lists right away, while it fetches
+# fresh ones in the background. None disables it.
+CACHE_SNAPSHOT_PATH = None
+# On startup, every worker fetches the lists for the workspaces of its
+# bridges, using up to CACHE_PREWARM_THREADS requests at once. Messages
+# are handled meanwhile; those needing a list still being fetched wait
+# for it. 0 disables it.
+CACHE_PREWARM_THREADS = 4
+# Users and channels that are not in the cached lists (say, someone
+# who just joined) are looked up one by one, LOOKUP_THREADS at a time,
+# in the background, instead of fetching the lists again. The message
+# goes untranslated, the next ones benefit; or it waits at most
+# LOOKUP_WAIT seconds for its lookups, holding up the messages behind
+# it. Ids that are not found are not looked up again for
+# LOOKUP_NEGATIVE_TTL seconds.
+LOOKUP_THREADS = 2
+LOOKUP_WAIT = 0
+LOOKUP_NEGATIVE_TTL = 300
+# Messages per second per incoming webhook, and how many may be sent at
+# once. After WEBHOOK_BREAKER_THRESHOLD failures in a row, we stop posting
+# to that webhook for WEBHOOK_BREAKER_COOLDOWN seconds (doubling each
+# time it still fails).
+WEBHOOK_RATE = 1.0
+WEBHOOK_BURST = 3
+WEBHOOK_BREAKER_THRESHOLD = 5
+WEBHOOK_BREAKER_COOLDOWN = 30
+# Merge consecutive messages by the same user to the same channel, if
+# they come within COALESCE_WINDOW seconds of the first one. This saves
+# posts (and rate limit) when someone pastes line by line, but delays
+# every message by up to the window. 0 disables it.
+COALESCE_WINDOW = 0
+COALESCE_MAX_CHARS = 3000
+# Commands (!info) run in a separate lane of CONTROL_THREADS threads
+# per worker, so that ordinary messages do not wait for them. At most
+# CONTROL_MAX_PENDING may be waiting or running; more are ignored.
+CONTROL_THREADS = 2
+CONTROL_MAX_PENDING = 20
+# Directory to journal queued messages to, so they survive a worker
+# crash or restart. Needs one subdirectory per front-end process. Keep
+# RESPONSE_WORKERS the same, or let the spool drain, before changing
+# it. The journal is fsynced at most every SPOOL_FSYNC_INTERVAL seconds
+# (0 means for every message). None disables it.
+SPOOL_PATH = None
+SPOOL_FSYNC_INTERVAL = 0.1
+# Larger POST bodies are refused.
+MAX_BODY_SIZE = 256 * 1024
+# Every call to Slack gets HTTP_CONNECT_TIMEOUT seconds to connect,
+# HTTP_READ_TIMEOUT seconds for every read and HTTP_TOTAL_TIMEOUT
+# seconds altogether. A worker spends at most MESSAGE_DEADLINE seconds
+# on a message: the users and channels lists that are not fetched
+# HTTP_TOTAL_TIMEOUT seconds before that are skipped, so the post still
+# has its time; a post that fails is retried later. A message that
+# cannot be handed to a worker within ENQUEUE_TIMEOUT seconds is
+# refused with a 503.
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 10
+HTTP_TOTAL_TIMEOUT = 20
+MESSAGE_DEADLINE = 30
+ENQUEUE_TIMEOUT = 3
+# A worker that has not been seen alive for this many seconds is
+# killed and restarted; so is a worker that died. Keep it above
+# MESSAGE_DEADLINE.
+WORKER_HANG_TIMEOUT = 120
+# Slack retries an outgoing webhook if we answer too slowly; such
+# repeats are dropped for DEDUP_TTL seconds (remembering at most
+# DEDUP_MAX_SIZE messages). With more than one front-end process, set
+# DEDUP_PATH to an SQLite file to share what was seen between them.
+DEDUP_TTL = 600
+DEDUP_MAX_SIZE = 10000
+DEDUP_PATH = None
+# With asgi_application, at most ASGI_QUEUE_SIZE received messages per
+# worker may be waiting to be handed to it; more are refused with a 503
+# (and Slack retries them).
+ASGI_QUEUE_SIZE = 1000
+# Unix socket path of the shared dispatcher. If set, the front-end does
+# not start its own workers, but sends everything to a single dispatcher
+# process (start it with "python3 wsgi.py dispatcher"). Use this if you
+# run more than one uWSGI/gunicorn worker: then there is only one queue
+# and one set of caches, and messages stay in order.
+DISPATCHER_SOCKET = None
+try:
+    import slackbridgeconf as _conf
+except ImportError:
+    pass
+else:
+    for _name in (
+            'ALERT_DELAY', 'ALERT_INTERVAL', 'RESPONSE_WORKERS',
+            'CACHE_TTL', 'CACHE_NEGATIVE_TTL',
+            'CACHE_SNAPSHOT_PATH', 'CACHE_PREWARM_THREADS',
+            'LOOKUP_THREADS', 'LOOKUP_WAIT', 'LOOKUP_NEGATIVE_TTL',
+            'WEBHOOK_RATE', 'WEBHOOK_BURST', 'WEBHOOK_BREAKER_THRESHOLD',
+            'WEBHOOK_BREAKER_COOLDOWN', 'COALESCE_WINDOW',
+            'COALESCE_MAX_CHARS', 'CONTROL_THREADS',
+            'CONTROL_MAX_PENDING', 'SPOOL_PATH', 'SPOOL_FSYNC_INTERVAL',
+            'MAX_BODY_SIZE', 'HTTP_CONNECT_TIMEOUT', 'HTTP_READ_TIMEOUT',
+            'HTTP_TOTAL_TIMEOUT', 'MESSAGE_DEADLINE', 'ENQUEUE_TIMEOUT',
+            'WORKER_HANG_TIMEOUT', 'DEDUP_TTL',
+            'DEDUP_MAX_SIZE', 'DEDUP_PATH', 'ASGI_QUEUE_SIZE',
+            'DISPATCHER_SOCKET'):
+        globals()[_name] = getattr(_conf, _name, globals()[_name])
+    del _conf, _name
+
+# Globals initialized once below, under INIT_LOCK (requests may come
+# in on many threads at once).
 REQUEST_HANDLER = None
-RESPONSE_WORKER = None
+RESPONSE_WORKERS_QUEUE = None
+ASGI_FRONTEND = None
+INIT_LOCK = threading.Lock()
 
 # API URLs
-WA_USERS_LIST = 'https://slack.com/api/users.list?token=%(wa_token)s'
-WA_CHANNELS_LIST = ('https://slack.com/api/conversations.list?'
-                    'token=%(wa_token)s&exclude_archived=1&limit=1000')
-
-# Other
-UNSET = '<unset>'
+WA_BASE_URL = 'https://slack.com/api/'
+
+# Metrics, shown by GET /metrics. They live in shared memory, so the
+# front-end and the workers (forked later) update the same ones. The
+# worker metrics are shown by the dispatcher, if you use that.
+FRONTEND_METRICS = Registry()
+METRIC_REQUESTS = FRONTEND_METRICS.add(MetricCounter(
+    'slackbridge_requests_total', 'Outgoing webhook POSTs received.',
+    ('result',), ('queued', 'duplicate', 'timeout', 'failed')))
+METRIC_ENQUEUE_SECONDS = FRONTEND_METRICS.add(Histogram(
+    'slackbridge_enqueue_seconds',
+    'Time taken to hand a message to the workers.'))
+WORKER_METRICS = Registry()
+METRIC_QUEUE_DEPTH = WORKER_METRICS.add(Gauge(
+    'slackbridge_queue_depth', 'Messages waiting for a worker.',
+    (lambda: [(str(i.index), i.depth.value) for i in (
+        RESPONSE_WORKERS_QUEUE.stats() if RESPONSE_WORKERS_QUEUE else ())]),
+    ('shard',)))
+METRIC_QUEUE_WAIT_SECONDS = WORKER_METRICS.add(Histogram(
+    'slackbridge_queue_wait_seconds',
+    'Time between receiving a message and a worker picking it up.'))
+METRIC_TRANSLATE_SECONDS = WORKER_METRICS.add(Histogram(
+    'slackbridge_translate_seconds',
+    'Time taken to translate a message for the other side.'))
+METRIC_DELIVER_SECONDS = WORKER_METRICS.add(Histogram(
+    'slackbridge_deliver_seconds',
+    'Time taken by a single incoming webhook post, failed or not.'))
+METRIC_DELIVERIES = WORKER_METRICS.add(MetricCounter(
+    'slackbridge_deliveries_total', 'Incoming webhook posts, by result.',
+    ('result',), ('delivered', 'failed', 'retried', 'gave_up', 'throttled',
+                  'shed', 'coalesced')))
+METRIC_CACHE_LOOKUPS = WORKER_METRICS.add(MetricCounter(
+    'slackbridge_cache_lookups_total', 'Web API cache lookups, by result.',
+    ('cache', 'result'), [
+        (cache, result)
+        for cache in ('users.list', 'channels.list', 'conversations.members')
+        for result in ('hit', 'stale', 'snapshot', 'miss', 'timeout')]))
+METRIC_TIMEOUTS = WORKER_METRICS.add(MetricCounter(
+    'slackbridge_timeouts_total', 'Calls to Slack that timed out.',
+    ('call',), ('incoming_webhook', 'users.list', 'conversations.list',
+                'conversations.members', 'users.info',
+                'conversations.info')))
+METRIC_BACKFILLS = WORKER_METRICS.add(MetricCounter(
+    'slackbridge_backfill_lookups_total',
+    'Lookups of single users and channels missing from the lists.',
+    ('method', 'result'), [
+        (method, result)
+        for method in ('users.info', 'conversations.info')
+        for result in ('found', 'failed', 'negative', 'full')]))
 
 # # Optionally configure a basic logger. You'll probably want to place
 # # this in the slackbridgeconf.
@@ -109,27 +298,25 @@ log = logging.getLogger('slackbridge')
 # logger.addHandler(handler)
 
 
-def alarm(signum, frame):
-    mail_send_error('Timer hit', exc=None, args=(
-        ''.join(traceback.format_stack()),))
-    raise ValueError('SIGALRM')
-
-
 def mail_admins(subject, body):
     msg = MIMEText(body.encode('utf-8'), 'plain', 'utf-8')
     msg['Subject'] = Header(subject.encode('utf-8'), 'utf-8')
     msg['From'] = MAIL_FROM
     msg['To'] = ', '.join(MAIL_TO)
-    s = smtplib.SMTP('127.0.0.1')
+    s = smtplib.SMTP('127.0.0.1', timeout=10)
     s.sendmail(MAIL_FROM, list(MAIL_TO), msg.as_string())
     s.quit()
 
 
-def mail_send_error(shortmsg, exc=None, args=()):
-    mail_admins(
-        'Slack message send failed (%s): %s' % (shortmsg, exc),
-        'Please investigate. Args are:\n\n%s' % (
-            '\n\n'.join(str(i) for i in args)),)
+# Mails digests of the errors below from a background thread.
+ALERTS = Alerter(
+    (lambda subject, body: mail_admins(subject, body)),
+    delay=ALERT_DELAY, interval=ALERT_INTERVAL)
+
+
+def mail_send_error(shortmsg, exc=None, args=(), dest=None):
+    # Does not wait for the mail; see ALERTS.
+    ALERTS.alert(shortmsg, dest=dest, error=exc, details=args)
 
 
 class RequestHandler(object):
@@ -137,101 +324,202 @@ class RequestHandler(object):
         self.config = config
         self.logger = logger
         self.ipc = ipc
+        self.dedup = Deduplicator(
+            ttl=DEDUP_TTL, max_size=DEDUP_MAX_SIZE, path=DEDUP_PATH)
+        # The ipc (ShardedQueue or DispatcherClient) may be used from
+        # many threads at once.
         if base_path.endswith('/'):
             base_path = base_path[0:-1]
         self.base_path = base_path
 
     def request(self, environ, start_response):
-        # Single-threaded, so we can do this.
-        self.env = environ
-        self.start_response = start_response
+        # Nothing about the request is kept on self, so this may be
+        # called from many threads at once.
+        status, headers, body = self.handle(environ)
+        start_response(status, headers)
+        return [body]
 
-        # Get all needed values.
+    def handle(self, environ):
+        """
+        Return (status, headers, body) for the request in environ.
+        """
         method = environ.get('REQUEST_METHOD')
-        path_info = environ.get('PATH_INFO')
-        assert (path_info == self.base_path or
-                path_info.startswith(self.base_path + '/')), \
-            'PATH_INFO %r does not start with %r' % (path_info, self.base_path)
-        self.path_info = path_info[len(self.base_path):]
+        path_info = self.get_path_info(environ)
 
         # Is it a POST or a GET?
         if method == 'GET':
-            return self.get()
+            return self.get(path_info, environ)
         elif method == 'POST':
-            payload = self.get_payload(environ)
-            return self.post(payload)
+            try:
+                payload = self.get_payload(environ)
+            except BadRequest as e:
+                log.info('Bad POST: %s', e)
+                return e.status, [], e.status.split(' ', 1)[0].encode('utf-8')
+            return self.post(path_info, payload)
         else:
-            self.start_response('405 Method Not Allowed', [
-                ('Allow', 'GET, POST')])
-            return [b'405']
+            return '405 Method Not Allowed', [('Allow', 'GET, POST')], b'405'
+
+    def get_path_info(self, environ):
+        path_info = environ.get('PATH_INFO')
+        assert (path_info == self.base_path or
+                path_info.startswith(self.base_path + '/')), \
+            'PATH_INFO %r does not start with %r' % (path_info, self.base_path)
+        return path_info[len(self.base_path):]
+
+    def get(self, path_info, environ):
+        log.debug('Handle GET: %s', path_info)
+        if path_info == '/metrics':
+            return self.get_metrics()
+        elif path_info == '/healthz':
+            return self.get_health()
 
-    def get(self):
-        log.debug('Handle GET: %s', self.path_info)
         # This data tests the subprocess.
-        self.ipc.send('PING @ %s: %s' %
-                      (datetime.datetime.now(), self.path_info))
+        self.ipc.send('PING @ %s: %s' % (datetime.datetime.now(), path_info))
+        stats = self.ipc.stats()
         # Return some debug info.
-        self.start_response(
-            '200 OK', [('Content-type', 'text/plain; charset=utf-8')])
-        return [('Default GET:\n' + pformat(self.env)).encode('utf-8')]
-
-    def post(self, payload):
-        log.debug('Handle POST: %s, %r', self.path_info, payload)
+        return '200 OK', [('Content-type', 'text/plain; charset=utf-8')], (
+            'Default GET:\n' + pformat(environ) + '\n\n' + '\n'.join(
+                str(i) for i in stats)).encode('utf-8')
+
+    def get_health(self):
+        # Cheap: only looks at the shared heartbeats, sends nothing.
+        health = self.ipc.health()
+        status = (
+            '200 OK' if all(i['alive'] for i in health)
+            else '503 Service Unavailable')
+        return status, [
+            ('Content-type', 'application/json; charset=utf-8')], (
+            json.dumps({'workers': health}).encode('utf-8'))
+
+    def get_metrics(self):
+        text = FRONTEND_METRICS.render()
+        if DISPATCHER_SOCKET:
+            text += self.ipc.metrics()
+        else:
+            text += WORKER_METRICS.render()
+        return '200 OK', [
+            ('Content-type', 'text/plain; version=0.0.4; charset=utf-8')], (
+            text.encode('utf-8'))
 
-        if self.path_info == '/outgoing':
-            # Just put the entire postdata in the queue.
+    def post(self, path_info, payload):
+        log.debug('Handle POST: %s, %r', path_info, payload)
 
-            # Set an alarm to catch any unintended hangs along the road.
-            # XXX: does not work??
-            signal.signal(signal.SIGALRM, alarm)
-            signal.alarm(3)
-            try:
-                self.ipc.send(self.get_fields(payload))
-            except Exception as e:
-                mail_send_error('Enqueue fail', exc=e, args=(
-                    traceback.format_exc(),))
-                self.start_response('503 Subprocess timeout', [])
-                return [b'503']
-            finally:
-                signal.alarm(0)
-
-            # Return the empty response.
-            self.start_response(
-                '200 OK', [('Content-type',
-                            'application/json; charset=utf-8')])
-            return ['{}'.encode('utf-8')]  # don't reply to outgoing messages..
+        if path_info == '/outgoing':
+            return self.outgoing(payload)
 
         # Unknown.
-        self.start_response('404 Not Found', [])
-        return [b'404']
+        return '404 Not Found', [], b'404'
+
+    def outgoing(self, payload):
+        ok = ('200 OK', [('Content-type', 'application/json; charset=utf-8')],
+              b'{}')  # don't reply to outgoing messages..
+
+        if self.dedup.is_duplicate(payload):
+            # Slack retried, but we got it the first time.
+            log.info('Dropping repeated message: %r', payload)
+            METRIC_REQUESTS.inc('duplicate')
+            return ok
+
+        # Just put the entire postdata in the queue.
+
+        # For the queue wait metric.
+        payload['_enqueued'] = t0 = time.time()
+        try:
+            self.ipc.send(payload)
+        except (TimeoutError, socket.timeout) as e:
+            # The workers are not keeping up; Slack will retry.
+            log.warning('Enqueue timeout: %s', e)
+            METRIC_REQUESTS.inc('timeout')
+            self.dedup.forget(payload)
+            return '503 Subprocess timeout', [], b'503'
+        except Exception as e:
+            METRIC_REQUESTS.inc('failed')
+            self.dedup.forget(payload)
+            mail_send_error('Enqueue fail', exc=e, args=(
+                traceback.format_exc(),))
+            return '503 Subprocess timeout', [], b'503'
+        METRIC_REQUESTS.inc('queued')
+        METRIC_ENQUEUE_SECONDS.observe(time.time() - t0)
+        return ok
 
     @staticmethod
     def get_payload(environ):
-        # We need to read CONTENT_TYPE and REQUEST_METHOD.
-        post_env = environ.copy()
-        post_env['QUERY_STRING'] = ''  # we don't want GET data in there
-        return cgi.FieldStorage(fp=environ['wsgi.input'], environ=post_env,
-                                keep_blank_values=True)
-
-    if hasattr(str, 'decode'):  # python2, decode data to unicode
-        @staticmethod
-        def get_fields(payload):
-            return dict((i, payload.getfirst(i).decode('utf-8'))
-                        for i in payload.keys())
-    else:  # python3, already unicode
-        @staticmethod
-        def get_fields(payload):
-            return dict((i, payload.getfirst(i)) for i in payload.keys())
+        return parse_body(environ, max_size=MAX_BODY_SIZE)
+
+
+class Delivery(object):
+    """
+    An incoming webhook post, possibly waiting for a retry.
+    """
+    def __init__(self, url, payload, failure_callback=None, seqs=(),
+                 deadline=None):
+        self.dest = self.url = url
+        self.payload = payload
+        self.failure_callback = failure_callback
+        # Spool sequence numbers of the messages in it, if spooled.
+        self.seqs = seqs
+        self.deadline = deadline  # for the first try only
+        self.tries = 0
+        self.error = None
+        self.response = None
 
 
 class ResponseHandler(object):
-    def __init__(self, config, logger):
-        self.config = config
+    def __init__(self, routes, logger, beat=None):
+        self.routes = routes
         self.log = logger
-        self.users_lists = {}
-        self.channels_lists = {}
+        # Called before every post, which may take HTTP_TOTAL_TIMEOUT
+        # seconds: a worker working through many of them is alive.
+        self.beat = beat or (lambda: None)
+        # Keep-alive connections to hooks.slack.com and slack.com.
+        self.http = ConnectionPool(
+            connect_timeout=HTTP_CONNECT_TIMEOUT,
+            read_timeout=HTTP_READ_TIMEOUT, total_timeout=HTTP_TOTAL_TIMEOUT)
+        # Failed incoming webhook posts wait here, instead of sleeping.
+        self.retries = RetryScheduler(max_tries=5)
+        # Slack allows about one message per second per incoming webhook.
+        self.limits = RateLimiter(
+            rate=WEBHOOK_RATE, burst=WEBHOOK_BURST,
+            threshold=WEBHOOK_BREAKER_THRESHOLD,
+            cooldown=WEBHOOK_BREAKER_COOLDOWN)
+        # Delivered, failed, throttled and shed message counts.
+        self.counters = Counter()
+        # Optionally merge bursts of messages by the same user.
+        self.coalescer = Coalescer(
+            self.post_coalesced, window=COALESCE_WINDOW,
+            max_chars=COALESCE_MAX_CHARS)
+        # Slow commands run here, next to the forwarding.
+        self.control = Lane(
+            threads=CONTROL_THREADS, max_pending=CONTROL_MAX_PENDING)
+        self.api = WebApi(
+            self.http, base_url=WA_BASE_URL, timeouts=METRIC_TIMEOUTS)
+        # Optional snapshot of the caches on disk, shared by all
+        # processes on this host.
+        store = CACHE_SNAPSHOT_PATH and SnapshotStore(CACHE_SNAPSHOT_PATH)
+        self.users_lists = TTLCache(
+            'users.list', self.api.users_list,
+            ttl=CACHE_TTL, negative_ttl=CACHE_NEGATIVE_TTL,
+            store=store, dump=dump_users, load=load_users,
+            lookups=METRIC_CACHE_LOOKUPS)
+        self.channels_lists = TTLCache(
+            'channels.list', self.api.channels_list,
+            ttl=CACHE_TTL, negative_ttl=CACHE_NEGATIVE_TTL,
+            default=ChannelList, store=store, dump=dump_channels,
+            load=load_channels, lookups=METRIC_CACHE_LOOKUPS)
+        self.channel_members = TTLCache(
+            'conversations.members', self.api.channel_members,
+            ttl=CACHE_TTL, negative_ttl=CACHE_NEGATIVE_TTL, default=tuple,
+            store=store, load=tuple, lookups=METRIC_CACHE_LOOKUPS)
+        # Fills in the users and channels missing from those lists.
+        self.backfill = Backfill(
+            self.api, threads=LOOKUP_THREADS,
+            negative_ttl=LOOKUP_NEGATIVE_TTL, lookups=METRIC_BACKFILLS)
+
+    def respond(self, outgoingwh_values, seq=None, deadline=None):
+        # Spend no more than MESSAGE_DEADLINE seconds on it.
+        if deadline is None:
+            deadline = time.time() + MESSAGE_DEADLINE
 
-    def respond(self, outgoingwh_values):
         # Never forward messages from the slackbot, they could cause
         # infinite loops. Especially considering that our own posted
         # messages get that exact user_id.
@@ -242,43 +530,35 @@ class ResponseHandler(object):
 
         # Translate.
         owh_token = outgoingwh_values['token']
-        config = self.config.get(owh_token)
-        if not config:
+        route = self.routes.get(owh_token)
+        if not route:
             self.log.info('OWH token %s not found in config...', owh_token)
             return
 
         # Exceptions to regular forwarding.
         if outgoingwh_values['text'] == '!info':
-            # Fetch info, and send to local channel only.
-            info = self.get_info(owh_token)
-            try:
-                remote_config = self.config[config['owh_linked']]
-                remote_iwh_url = remote_config['iwh_url']
-            except KeyError:
-                self.log.warn('Could not get linked IWH URL')
-            else:
-                reply_payload = {
-                    'text': '(local reply only)\n' + '\n'.join(
-                        '@%s %s: %s' % (
-                            i['atchannel'], i['channel'],
-                            ', '.join(sorted(i['users'])))
-                        for i in sorted(info.values(),
-                                        key=(lambda x: x['channel']))),
-                    'channel': '#' + outgoingwh_values['channel_name'],
-                    'mrkdwn': False,
-                }
-                # Send.
-                self.log.info(
-                    'Responding with %r to %s', reply_payload, remote_iwh_url)
-                self.incomingwh_post(remote_iwh_url, reply_payload)
+            # Fetch info in the control lane, and send to local channel
+            # only once we have it. Other messages go on meanwhile.
+            channel = '#' + outgoingwh_values['channel_name']
+            if not self.control.submit(
+                    (lambda info: self.info_reply(route, channel, info, seq)),
+                    self.get_info, route, seq=seq):
+                self.log.warn('Too many commands running, ignoring %r',
+                              outgoingwh_values)
             return
 
-        users_list = self.get_users_list(
-            owh_token, config.get('wa_token'))
+        # Waiting for the lists may not eat into the time for the post.
+        lists_deadline = deadline - HTTP_TOTAL_TIMEOUT
+        users_list = self.get_users_list(route.wa_token, lists_deadline)
         channels_list = self.get_channels_list(
-            owh_token, config.get('wa_token'))
+            route.wa_token, lists_deadline)
+        self.fill_missing(
+            route.wa_token, outgoingwh_values, users_list, channels_list,
+            lists_deadline)
+        t0 = time.time()
         payload = self.outgoingwh_to_incomingwh(
-            outgoingwh_values, config['iwh_update'], users_list, channels_list)
+            outgoingwh_values, route, users_list, channels_list)
+        METRIC_TRANSLATE_SECONDS.observe(time.time() - t0)
 
         # Check for empty messages (a sign of attachments/photos):
         if not payload.get('text') and 'username' in payload:
@@ -290,32 +570,78 @@ class ResponseHandler(object):
                 'channel': '#' + outgoingwh_values['channel_name'],
                 'mrkdwn': False,
             }
-            try:
-                remote_config = self.config[config['owh_linked']]
-                remote_iwh_url = remote_config['iwh_url']
-            except KeyError:
+            if not route.reply_url:
                 self.log.warn('Could not get linked IWH URL')
             else:
-                self.log.info(
-                    'Responding with %r to %s', reply_payload, remote_iwh_url)
-                self.incomingwh_post(remote_iwh_url, reply_payload)
-
-            # Update forwarded messsage.
-            reply_payload['channel'] = payload['channel']  # peer-side channel
-            payload = reply_payload
-
+                self.log.info('Responding with %r to %s',
+                              reply_payload, route.reply_url)
+                self.incomingwh_post(
+                    route.reply_url, reply_payload, seqs=(seq,),
+                    deadline=deadline)
+
+            # Update forwarded messsage. A copy: the reply may still be
+            # waiting for its post (rate limit, retry).
+            payload = dict(reply_payload, channel=payload['channel'])
+
+        # Send, possibly merged with the next few messages.
+        self.coalescer.add(
+            (route.peer_url, payload['channel']), payload,
+            (outgoingwh_values, route, seq, deadline))
+
+    def post_coalesced(self, pending):
+        outgoingwh_values, route, seq, deadline = pending.context
+        # Keep all merged messages in the spool until this is done.
+        seqs = tuple(i[2] for i in pending.contexts)
+        payload = pending.payload
+        if pending.count > 1:
+            self.count('coalesced', pending.count)
+        # Time spent held does not count against the message.
+        deadline += max(0, time.time() - pending.started)
+        self.log.info('Responding with %r to %s', payload, route.peer_url)
+        self.incomingwh_post(route.peer_url, payload, failure_callback=(
+            self.create_error_response(outgoingwh_values, route, payload)),
+            seqs=seqs, deadline=deadline)
+
+    def info_reply(self, route, channel, info, seq=None):
+        if not route.reply_url:
+            self.log.warn('Could not get linked IWH URL')
+            return
+        reply_payload = {
+            'text': '(local reply only)\n' + '\n'.join(
+                '@%s %s: %s' % (
+                    i['atchannel'], i['channel'],
+                    ', '.join(sorted(i['users'])))
+                for i in sorted(info.values(),
+                                key=(lambda x: x['channel']))),
+            'channel': channel,
+            'mrkdwn': False,
+        }
         # Send.
-        self.log.info('Responding with %r to %s', payload, config['iwh_url'])
-        self.incomingwh_post(config['iwh_url'], payload, failure_callback=(
-            self.create_error_response(outgoingwh_values, config, payload)))
+        self.log.info('Responding with %r to %s',
+                      reply_payload, route.reply_url)
+        self.incomingwh_post(route.reply_url, reply_payload, seqs=(seq,))
 
-    def create_error_response(self, outgoingwh_values, config,
+    def count(self, result, amount=1):
+        self.counters[result] += amount
+        METRIC_DELIVERIES.inc(result, amount)
+
+    def unfinished_seqs(self):
+        """
+        Return the spool sequence numbers of the messages that are still
+        held, waiting for a retry or running as a command.
+        """
+        seqs = set(seq for i in self.retries.jobs() for seq in i.seqs)
+        seqs.update(self.control.seqs())
+        seqs.update(
+            i[2] for pending in self.coalescer.pending()
+            for i in pending.contexts)
+        seqs.discard(None)
+        return seqs
+
+    def create_error_response(self, outgoingwh_values, route,
                               payload_that_failed):
         def on_failure():
-            try:
-                remote_config = self.config[config['owh_linked']]
-                remote_iwh_url = remote_config['iwh_url']
-            except KeyError:
+            if not route.reply_url:
                 self.log.warn('Could not get linked IWH URL')
             else:
                 payload = {
@@ -326,12 +652,12 @@ class ResponseHandler(object):
                     'channel': '#' + outgoingwh_values['channel_name'],
                     'mrkdwn': False,
                 }
-                self.incomingwh_post(remote_iwh_url, payload)
+                self.incomingwh_post(route.reply_url, payload)
 
         return on_failure
 
     @classmethod
-    def outgoingwh_to_incomingwh(cls, outgoingwh_values, update,
+    def outgoingwh_to_incomingwh(cls, outgoingwh_values, route,
                                  users_list, channels_list):
         # https://api.slack.com/docs/formatting
         #
@@ -365,22 +691,18 @@ class ResponseHandler(object):
         # users, we won't use parse=none, but will use link_names=1.
         #
         payload = {
-            'text': cls.outgoingwh_fixtext(
-                outgoingwh_values['text'],
-                users_list, channels_list,
-                atchannel=update.get('_atchannel')),
+            'text': route.rewriter.rewrite(
+                outgoingwh_values['text'], users_list, channels_list),
             'channel': '#' + outgoingwh_values['channel_name'],
             'username': outgoingwh_values['user_name'],
             'link_names': 1,
         }
 
-        icon_url = (users_list.get(outgoingwh_values['user_id'], {})
-                    .get('image_32'))
-        if icon_url:
-            payload.update({'icon_url': icon_url})
+        user = users_list.get(outgoingwh_values['user_id'])
+        if user and user.image_32:
+            payload.update({'icon_url': user.image_32})
 
-        payload.update(
-            dict((k, v) for k, v in update.items() if not k.startswith('_')))
+        payload.update(route.template)
         return payload
 
     @classmethod
@@ -394,296 +716,369 @@ class ResponseHandler(object):
         Replace "abc <#C03CYDD1R> def" with "abc #somechan def" if we have that
         channel in our list.
         """
-        def replace_channel(match):
-            channel_id = match.groups()[0]
-            try:
-                return '#' + channels_list[channel_id]['name']
-            except KeyError:
-                return '<#' + channel_id + '>'  # untouched
-
-        def replace_user(match):
-            user_id = match.groups()[0]
-            # <@UABC|somename>, used in file uploads:
-            # 'text': '<@UABC|somename> uploaded a file: ...'
-            if '|' in user_id:
-                return '@' + user_id.split('|', 1)[1]
-            # <@UABC>, used in other places:
-            # 'text': '<@UABC>: you forget that file sending fails'
-            try:
-                return '@' + users_list[user_id]['name']
-            except KeyError:
-                return '<@' + user_id + '>'  # untouched
-
-        # @teamname => @channel
-        if atchannel:
-            text = re.sub(r'(^|[^\w])@' + atchannel + r'\b',
-                          r'\1@channel',
-                          text,
-                          flags=re.I)
-
-        # <@U123> => @user
-        text = re.sub(r'<@(U[^>]+)>', replace_user, text)
-
-        # <#C123> => #channel
-        text = re.sub(r'<#(C[^>]+)>', replace_channel, text)
-
-        return text
+        rewriter = TextRewriter.for_atchannel(atchannel)
+        return rewriter.rewrite(text, users_list, channels_list)
+
+    def incomingwh_post(self, url, payload, failure_callback=None,
+                        seqs=(), deadline=None):
+        delivery = Delivery(url, payload, failure_callback, seqs, deadline)
+        if self.retries.is_blocked(url):
+            # Earlier messages to this URL are waiting for a retry; queue
+            # behind them to keep the order.
+            if not self.retries.defer(delivery):
+                self.count('shed')
+                self.incomingwh_give_up(delivery, 'Retry queue full')
+            return
+        self.incomingwh_deliver(delivery)
+
+    def incomingwh_deliver(self, delivery):
+        # The message deadline only holds if we try right away; later
+        # tries get HTTP_TOTAL_TIMEOUT.
+        deadline, delivery.deadline = delivery.deadline, None
+        self.beat()
+        limits = self.limits[delivery.url]
+        wait = limits.wait()
+        if wait:
+            # Rate limited or circuit open: we may not try yet.
+            self.count('throttled')
+            self.retries.delay(delivery, wait)
+            return
 
-    @classmethod
-    def incomingwh_post(cls, url, payload, failure_callback=None):
-        data = parse.urlencode({'payload': json.dumps(payload)})
+        data = parse.urlencode({'payload': json.dumps(delivery.payload)})
         log.debug('incomingwh_post: send: %r', data)
 
-        tries = 5
-        for i in range(tries):
-            try:
-                response = request.urlopen(url, data.encode('utf-8'))
-            except Exception as e:
-                log.error('Posting message (try %d) failed: %s', i, e)
-                if hasattr(e, 'fp'):
-                    ret = e.fp.read()
-                    log.info('Got data: %r', ret)
-
-                if i < (tries - 1):
-                    time.sleep(3 * i + 1)
-                else:
-                    log.error('Posting message failed completely: %s', e)
-                    mail_send_error('POST failed 3x', exc=e, args=(
-                        repr(payload), repr(ret)))
-                    if failure_callback:
-                        failure_callback()
-            else:
-                data = response.read()
-                log.debug('incomingwh_post: recv: %r', data)
-                if data == b'ok':
-                    break
-
-    def get_users_list(self, owh_token, wa_token):
-        # Check if we have the list already.
-        # TODO: this is now infinitely cached, not nice
-        if owh_token not in self.users_lists:
-            if not wa_token:
-                return {}
-
-            self.log.info('Fetching users.list for %s...', owh_token)
-            url = WA_USERS_LIST % {'wa_token': wa_token}
-            try:
-                response = request.urlopen(url)
-            except Exception as e:
-                self.log.error('Fetching users.list failed: %s', e)
-                if hasattr(e, 'fp'):
-                    data = e.fp.read()
-                    self.log.info('Got data: %r', data)
-                self.users_lists[owh_token] = {}
-            else:
-                data = response.read()
-                data = data.decode('utf-8', 'replace')
-                self.log.debug('Got users.list data: %r', data)
-                data = json.loads(data)
-                if data['ok']:
-                    users = data.get('members', [])
-                    users = dict(
-                        (i.get('id'),
-                         {'name': i.get('name', UNSET),
-                          'image_32': i.get('profile', {}).get('image_32')})
-                        # (don't load deleted users)
-                        for i in users if not i.get('deleted', False))
-                    self.users_lists[owh_token] = users
-                    self.log.debug(
-                        'users_list: %r', self.users_lists[owh_token])
-                else:
-                    self.log.error(
-                        'Fetching users.list failed: %s', data['error'])
-                    self.users_lists[owh_token] = {}
-
-        return self.users_lists[owh_token]
+        t0 = time.time()
+        try:
+            response = self.http.urlopen(
+                delivery.url, data.encode('utf-8'), deadline=deadline)
+        except Exception as e:
+            METRIC_DELIVER_SECONDS.observe(time.time() - t0)
+            if isinstance(e, socket.timeout):
+                METRIC_TIMEOUTS.inc('incoming_webhook')
+            if getattr(e, 'code', None) == 429:
+                # Slack wants us to slow down. This does not count as a
+                # failed try.
+                retry_after = self.get_retry_after(e)
+                log.info('Posting message throttled, retry after %.1fs',
+                         retry_after)
+                self.count('throttled')
+                limits.throttled(retry_after)
+                self.retries.delay(delivery, retry_after)
+                return
+            log.error('Posting message (try %d) failed: %s',
+                      delivery.tries, e)
+            delivery.error = e
+            if hasattr(e, 'fp'):
+                delivery.response = e.fp.read()
+                log.info('Got data: %r', delivery.response)
+        else:
+            delivery.response = response.read()
+            METRIC_DELIVER_SECONDS.observe(time.time() - t0)
+            log.debug('incomingwh_post: recv: %r', delivery.response)
+            if delivery.response == b'ok':
+                self.count('delivered')
+                limits.success()
+                self.retries.release(delivery.url)
+                return
+            delivery.error = ValueError('unexpected response')
+
+        self.count('failed')
+        limits.failure()
+        if self.retries.retry(delivery):
+            self.count('retried')
+        else:
+            self.incomingwh_give_up(delivery, 'POST failed %dx' % (
+                delivery.tries,))
+            self.retries.release(delivery.url)
 
-    def get_channels_list(self, owh_token, wa_token):
-        # Check if we have the list already.
-        # TODO: this is now infinitely cached, not nice
-        if owh_token not in self.channels_lists:
-            if not wa_token:
-                return {}
+    @staticmethod
+    def get_retry_after(exc, default=5.0):
+        try:
+            return max(1.0, float(exc.headers.get('Retry-After')))
+        except (AttributeError, TypeError, ValueError):
+            return default
+
+    def incomingwh_give_up(self, delivery, shortmsg):
+        self.count('gave_up')
+        log.error('Posting message failed completely: %s', delivery.error)
+        mail_send_error(shortmsg, exc=delivery.error, args=(
+            repr(delivery.payload), repr(delivery.response)),
+            # Without the secret part of the webhook URL.
+            dest=delivery.url.rsplit('/', 1)[0])
+        if delivery.failure_callback:
+            delivery.failure_callback()
+
+    def run_due(self):
+        """
+        Flush the held (coalesced) messages, retry the failed
+        deliveries that are due and answer the finished commands. Call
+        this from the worker loop; due_timeout() tells you when to call
+        it next.
+        """
+        self.coalescer.flush_due()
+        for delivery in self.retries.pop_due():
+            self.incomingwh_deliver(delivery)
+        self.control.run_finished()
+
+    def due_timeout(self):
+        timeouts = [i for i in (
+            self.coalescer.timeout(), self.retries.timeout(),
+            self.control.timeout())
+            if i is not None]
+        return min(timeouts) if timeouts else None
+
+    def get_users_list(self, wa_token, deadline=None):
+        # Only the first call waits for Slack (until the deadline, if
+        # given). After CACHE_TTL, the old list is returned while a fresh
+        # one is fetched in the background.
+        # Lists are cached per workspace: bridges may share a wa_token.
+        if not wa_token:
+            return {}
+        return self.users_lists.get(
+            workspace_key(wa_token), wa_token,
+            timeout=self.time_left(deadline))
+
+    def get_channels_list(self, wa_token, deadline=None):
+        if not wa_token:
+            return ChannelList()
+        return self.channels_lists.get(
+            workspace_key(wa_token), wa_token,
+            timeout=self.time_left(deadline))
 
-            self.log.info('Fetching channels.list for %s...', owh_token)
-            url = WA_CHANNELS_LIST % {'wa_token': wa_token}
-            try:
-                response = request.urlopen(url)
-            except Exception as e:
-                self.log.error('Fetching channels.list failed: %s', e)
-                if hasattr(e, 'fp'):
-                    data = e.fp.read()
-                    self.log.info('Got data: %r', data)
-                self.channels_lists[owh_token] = {}
-            else:
-                data = response.read()
-                data = data.decode('utf-8', 'replace')
-                self.log.debug('Got channels.list data: %r', data)
-                data = json.loads(data)
-                if data['ok']:
-                    channels = data.get('channels', [])
-                    channels = dict(
-                        (i.get('id'),
-                         {'name': i.get('name', UNSET)})
-                        for i in channels)
-                    self.channels_lists[owh_token] = channels
-                    self.log.debug(
-                        'channels_list: %r', self.channels_lists[owh_token])
-                else:
-                    self.log.error(
-                        'Fetching channels.list failed: %s', data['error'])
-                    self.channels_lists[owh_token] = {}
+    @staticmethod
+    def time_left(deadline):
+        if deadline is None:
+            return None
+        return max(0, deadline - time.time())
 
-        return self.channels_lists[owh_token]
+    def fill_missing(self, wa_token, outgoingwh_values, users_list,
+                     channels_list, deadline=None):
+        """
+        Look up the author and the mentioned users and channels that are
+        not in the lists, waiting at most LOOKUP_WAIT seconds (and not
+        past the deadline) for them.
+        """
+        if not wa_token:
+            return
+        user_ids, channel_ids = TextRewriter.missing(
+            outgoingwh_values['text'], users_list, channels_list)
+        if outgoingwh_values['user_id'] not in users_list:
+            user_ids.add(outgoingwh_values['user_id'])  # for the avatar
+        # Only add to the cached lists; not to an empty one we got for
+        # now because the list was not fetched in time.
+        key = workspace_key(wa_token)
+        if users_list is not self.users_lists.peek(key):
+            user_ids = ()
+        if channels_list is not self.channels_lists.peek(key):
+            channel_ids = ()
+        futures = [
+            self.backfill.user(wa_token, users_list, i) for i in user_ids]
+        futures.extend(
+            self.backfill.channel(wa_token, channels_list, i)
+            for i in channel_ids)
+        futures = [i for i in futures if i]
+        if futures and LOOKUP_WAIT:
+            timeout = self.time_left(deadline)
+            wait(futures, timeout=(
+                LOOKUP_WAIT if timeout is None
+                else min(LOOKUP_WAIT, timeout)))
+
+    def prewarm(self, wa_tokens, threads=4):
+        """
+        Fill the users and channels caches for these workspaces, fetching
+        them concurrently. Returns the seconds it took.
+        """
+        t0 = time.time()
+        with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+            futures = [
+                executor.submit(func, wa_token)
+                for wa_token in wa_tokens
+                for func in (self.get_users_list, self.get_channels_list)]
+            for future in futures:
+                future.exception()  # wait; TTLCache logs the failures
+        seconds = time.time() - t0
+        self.log.info('Prewarmed caches for %d workspaces in %.3fs',
+                      len(wa_tokens), seconds)
+        return seconds
 
     def get_channel_members(self, wa_token, channel_name):
         """
-        We could get the channel info from the ``channel.info`` call,
-        but then we need the channel id (C9999ZZZZ), which we don't
-        have.
+        Look up the channel id (C9999ZZZZ) in the cached channels list,
+        and get the members of only that channel.
         """
-        self.log.info('Fetching channels.list for %s...', channel_name)
-        url = WA_CHANNELS_LIST % {'wa_token': wa_token}
-        try:
-            response = request.urlopen(url)
-        except Exception as e:
-            self.log.error('Fetching channels.list failed: %s', e)
-            if hasattr(e, 'fp'):
-                data = e.fp.read()
-                self.log.info('Got data: %r', data)
-        else:
-            data = response.read()
-            data = data.decode('utf-8', 'replace')
-            self.log.debug('Got channels.list data: %r', data)
-            data = json.loads(data)
-            if data['ok']:
-                channels = data.get('channels', [])
-                for channel in channels:
-                    if channel.get('name') == channel_name:
-                        return channel.get('members', [])
-            else:
-                self.log.error(
-                    'Fetching channels.list failed: %s', data['error'])
-        return []
-
-    def get_channel_users(self, owh_token, wa_token, channel_name):
+        channel = self.get_channels_list(wa_token).find(channel_name)
+        if not channel:
+            self.log.info('Channel %s not found', channel_name)
+            return ()
+        return self.channel_members.get(
+            (workspace_key(wa_token), channel.id), wa_token, channel.id)
+
+    def get_channel_users(self, wa_token, channel_name):
         members = self.get_channel_members(wa_token, channel_name)
         if not members:
-            return members
+            return []
 
-        users_list = self.get_users_list(owh_token, wa_token)
+        users_list = self.get_users_list(wa_token)
         return [
             # Fetch names of everyone in channel, but only if we have the
             # name-mapping. If we don't have the name, the user is probably
             # deleted.
-            username for username in [
-                users_list.get(i, {'name': False})['name'] for i in members]
-            if username]
+            users_list[i].name for i in members if i in users_list]
 
-    def get_info(self, local_owh_token):
+    def get_info(self, local):
         # Get info about channel linkage and local and remote users.
-        local_config = self.config[local_owh_token]
-        local_channel = remote_channel = UNSET
-        local_atchannel = remote_atchannel = UNSET
-        local_users = remote_users = []
-        local_wa_token = local_config.get('wa_token', '')
-
-        remote_owh_token = local_config.get('owh_linked')
-        remote_config = self.config.get(remote_owh_token, {})
-        remote_wa_token = remote_config.get('wa_token', '')
-
-        try:
-            if local_config['iwh_update']['channel'][0:1] == '#':
-                remote_channel = local_config['iwh_update']['channel'][1:]
-            elif remote_config:
-                # Lookup channel name from channel id.
-                channels_list = self.get_channels_list(
-                    remote_owh_token, remote_wa_token)
-                tmp_channel = channels_list.get(
-                    local_config['iwh_update']['channel'])
-                if tmp_channel:
-                    remote_channel = tmp_channel['name']
-        except KeyError:
-            pass
-
-        try:
-            remote_atchannel = local_config['iwh_update']['_atchannel']
-        except KeyError:
-            pass
-
-        if remote_config:
-            try:
-                if remote_config['iwh_update']['channel'][0:1] == '#':
-                    local_channel = remote_config['iwh_update']['channel'][1:]
-                else:
-                    # Lookup channel name from channel id.
-                    channels_list = self.get_channels_list(
-                        local_owh_token, local_wa_token)
-                    tmp_channel = channels_list.get(
-                        remote_config['iwh_update']['channel'])
-                    if tmp_channel:
-                        local_channel = tmp_channel['name']
-            except KeyError:
-                pass
-            try:
-                local_atchannel = remote_config['iwh_update']['_atchannel']
-            except KeyError:
-                pass
-
-        if local_channel and local_wa_token:
-            local_users = self.get_channel_users(
-                local_owh_token, local_wa_token, local_channel)
-        if remote_channel and remote_wa_token:
-            remote_users = self.get_channel_users(
-                remote_owh_token, remote_wa_token, remote_channel)
+        # Both sides are looked up at the same time.
+        remote = self.routes.get(local.peer_token)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            local_side = executor.submit(
+                self.get_side_info, local.wa_token, remote and remote.channel)
+            remote_side = executor.submit(
+                self.get_side_info, remote and remote.wa_token, local.channel)
+            local_channel, local_users = local_side.result()
+            remote_channel, remote_users = remote_side.result()
 
         return {
-            local_owh_token: {'channel': '#' + local_channel,
-                              'users': local_users,
-                              'atchannel': local_atchannel},
-            remote_owh_token: {'channel': '#' + remote_channel,
+            local.token: {'channel': '#' + local_channel,
+                          'users': local_users,
+                          'atchannel': (remote and remote.atchannel) or UNSET},
+            local.peer_token: {'channel': '#' + remote_channel,
                                'users': remote_users,
-                               'atchannel': remote_atchannel},
+                               'atchannel': local.atchannel or UNSET},
         }
 
+    def get_side_info(self, wa_token, channel):
+        """
+        Return the name of channel (a #name, or an id to look up in the
+        workspace of wa_token) and the users in it there.
+        """
+        name = UNSET
+        if channel and channel[0:1] == '#':
+            name = channel[1:]
+        elif channel:
+            # Lookup channel name from channel id.
+            tmp_channel = self.get_channels_list(wa_token).get(channel)
+            if tmp_channel:
+                name = tmp_channel.name
+
+        users = []
+        if name != UNSET and wa_token:
+            users = self.get_channel_users(wa_token, name)
+        return name, users
+
     # def test(self, owh_token):
     #     x = self.get_info(owh_token)
     #     self.log.debug('TEST: %r', x)
 
 
-def response_worker(config, logger, ipc):
-    responsehandler = ResponseHandler(config=config, logger=logger)
+def run_guarded(logger, item, func, *args):
+    # Hangs are cut short by the deadlines on all Slack calls; a worker
+    # that hangs anyway is restarted by the supervisor.
     try:
+        func(*args)
+    except Exception as e:
+        logger.error('For item: %r', item)
+        logger.error(traceback.format_exc())
+        logger.warn('Continuing...')
+        mail_send_error('Forward failed', exc=e, args=(
+            repr(item), traceback.format_exc()))
+
+
+def response_worker(routes, logger, ipc, stats, spool=None, prewarm=(),
+                    metrics=None):
+    if metrics is not None:
+        # If we were not forked, the metrics we imported are our own;
+        # use the shared ones of the front-end.
+        WORKER_METRICS.attach(metrics)
+    responsehandler = ResponseHandler(
+        routes=routes, logger=logger, beat=stats.beat)
+    if prewarm and CACHE_PREWARM_THREADS:
+        thread = threading.Thread(
+            target=responsehandler.prewarm, name='prewarm',
+            args=(prewarm, CACHE_PREWARM_THREADS))
+        thread.daemon = True
+        thread.start()
+    # All spooled items before next_seq have been handled.
+    next_seq = 0
+
+    def handle(item, seq):
+        t0 = time.time()
+        if isinstance(item.get('_enqueued'), float):
+            METRIC_QUEUE_WAIT_SECONDS.observe(t0 - item['_enqueued'])
+        run_guarded(logger, item, responsehandler.respond, item, seq)
+        stats.done(time.time() - t0)
+
+    def acknowledge():
+        spool.ack(next_seq, responsehandler.unfinished_seqs())
+
+    try:
+        if spool:
+            replay = spool.replay()
+            next_seq = spool.acked()[0]
+            for seq, item in replay:
+                logger.info('Replaying spooled item %d', seq)
+                stats.beat()
+                handle(item, seq)
+                next_seq = max(next_seq, seq + 1)
+                acknowledge()
+
         item = None
         while True:
-            item = ipc.recv()
-            if item is None:
-                break
-            elif isinstance(item, str):
-                logger.info('Got string: %s', item)
-                # if item.rsplit('/', 1)[-1] in config:
-                #     responsehandler.test(item.rsplit('/', 1)[-1])
-            else:
-                try:
-                    # Set an alarm to catch any unintended hangs along
-                    # the road.
-                    signal.signal(signal.SIGALRM, alarm)
-                    signal.alarm(60)
-                    responsehandler.respond(item)
-                except Exception as e:
-                    logger.error('For item: %r', item)
-                    logger.error(traceback.format_exc())
-                    logger.warn('Continuing...')
-                    mail_send_error('Forward failed', exc=e, args=(
-                        repr(item), traceback.format_exc()))
-                finally:
-                    signal.alarm(0)
+            # Wait for new items, but only until the next held message
+            # or retry is due.
+            # Beat at least every HEARTBEAT_INTERVAL, so the front-end
+            # knows we are alive.
+            stats.beat()
+            timeout = responsehandler.due_timeout()
+            if timeout is None or timeout > HEARTBEAT_INTERVAL:
+                timeout = HEARTBEAT_INTERVAL
+            if ipc.poll(timeout):
+                item = ipc.recv()
+                stats.picked_up()
+                if item is None:
+                    break
+                elif isinstance(item, str):
+                    logger.info(
+                        'Got string: %s (%s, %s, open circuits %r)',
+                        item, stats, dict(responsehandler.counters),
+                        responsehandler.limits.open_circuits())
+                    # if item.rsplit('/', 1)[-1] in routes:
+                    #     responsehandler.test(item.rsplit('/', 1)[-1])
+                elif isinstance(item, tuple):
+                    seq, item = item
+                    if seq >= next_seq:  # else: already replayed
+                        handle(item, seq)
+                        next_seq = seq + 1
+                        acknowledge()
+                else:
+                    handle(item, None)
+
+            if responsehandler.due_timeout() == 0:
+                t0 = time.time()
+                run_guarded(logger, 'retries', responsehandler.run_due)
+                stats.busy_for(time.time() - t0)
+                if spool:
+                    acknowledge()
     except Exception as e:
         logger.error(traceback.format_exc())
         logger.error('Aborting...')
         mail_send_error('STOPPED', exc=e, args=(
             traceback.format_exc(),))
 
+    run_guarded(logger, 'shutdown', responsehandler.coalescer.flush_all)
+    if len(responsehandler.control):
+        logger.warn('Abandoning %d running commands%s',
+                    len(responsehandler.control),
+                    (' (they stay in the spool)' if spool else ''))
+    responsehandler.control.shutdown(wait=False)
+    if len(responsehandler.retries):
+        logger.warn('Leaving %d messages waiting for retry%s',
+                    len(responsehandler.retries),
+                    (' in the spool' if spool else ''))
+    if spool:
+        acknowledge()
+        spool.close()
+    ALERTS.flush()
+
 
 def application(environ, start_response):
     global REQUEST_HANDLER
@@ -698,34 +1093,91 @@ def application(environ, start_response):
     return REQUEST_HANDLER.request(environ, start_response)
 
 
+async def asgi_application(scope, receive, send):
+    """
+    The same, for ASGI servers: uvicorn wsgi:asgi_application
+    """
+    global ASGI_FRONTEND
+    if not ASGI_FRONTEND:
+        # Starting the workers blocks, but only once; with lifespan
+        # support this happens before the first request.
+        if not REQUEST_HANDLER:
+            init_globals()
+        ASGI_FRONTEND = AsgiFrontend(
+            REQUEST_HANDLER, max_body_size=MAX_BODY_SIZE,
+            queue_size=ASGI_QUEUE_SIZE, lanes=RESPONSE_WORKERS,
+            on_shutdown=(stop_workers if RESPONSE_WORKERS_QUEUE else None))
+    await ASGI_FRONTEND(scope, receive, send)
+
+
 def init_globals():
-    global REQUEST_HANDLER, RESPONSE_WORKER
-
-    log.info('Starting workers...')
-    # For some reason, using a Queue() did not work at all as soon
-    # as this was started from uWSGI. In buildin_httpd mode it
-    # worked fine. But in uWSGI the Queue seemed to buffer outgoing
-    # messages.
-    parent_pipe, child_pipe = Pipe()
-    RESPONSE_WORKER = Process(
-        target=response_worker, args=(CONFIG, log, child_pipe))
-    RESPONSE_WORKER.start()
-    REQUEST_HANDLER = RequestHandler(
-        config=CONFIG, logger=log, ipc=parent_pipe, base_path=BASE_PATH)
+    with INIT_LOCK:
+        if not REQUEST_HANDLER:  # another thread may have done it
+            _init_globals()
 
-    # Add handler to shutdown gracefully from uWSGI. This is needed
-    # for graceful uWSGI reload/shutdown.
-    try:
-        import uwsgi
-    except ImportError:
-        pass
+
+def _init_globals():
+    global REQUEST_HANDLER
+
+    if DISPATCHER_SOCKET:
+        # The workers run in the separate dispatcher process; see
+        # run_dispatcher().
+        log.info('Using dispatcher on %s...', DISPATCHER_SOCKET)
+        # Give the dispatcher time to answer after its ENQUEUE_TIMEOUT.
+        ipc = DispatcherClient(DISPATCHER_SOCKET, timeout=ENQUEUE_TIMEOUT + 2)
     else:
-        def goodbye():
-            log.debug('Stopping workers...')
-            REQUEST_HANDLER.ipc.send(None)  # HAXX
-            RESPONSE_WORKER.join()
-            log.info('Finished...')
-        uwsgi.atexit = goodbye
+        ipc = start_workers()
+
+        # Add handler to shutdown gracefully from uWSGI. This is needed
+        # for graceful uWSGI reload/shutdown.
+        try:
+            import uwsgi
+        except ImportError:
+            pass
+        else:
+            uwsgi.atexit = stop_workers
+
+    REQUEST_HANDLER = RequestHandler(
+        config=CONFIG, logger=log, ipc=ipc, base_path=BASE_PATH)
+
+
+def start_workers():
+    global RESPONSE_WORKERS_QUEUE
+
+    log.info('Starting %d workers...', RESPONSE_WORKERS)
+    RESPONSE_WORKERS_QUEUE = ShardedQueue(
+        RESPONSE_WORKERS, spool_path=SPOOL_PATH,
+        fsync_interval=SPOOL_FSYNC_INTERVAL,
+        hang_timeout=WORKER_HANG_TIMEOUT, send_timeout=ENQUEUE_TIMEOUT)
+    # Every worker prewarms the caches for the workspaces of the
+    # bridges it handles.
+    wa_tokens = dict((shard, set()) for shard in RESPONSE_WORKERS_QUEUE.shards)
+    for route in ROUTES.values():
+        if route.wa_token:
+            shard = RESPONSE_WORKERS_QUEUE.shard_for({'token': route.token})
+            wa_tokens[shard].add(route.wa_token)
+
+    def spawn(shard):
+        process = Process(
+            target=response_worker,
+            # A plain dict: the read-only ROUTES cannot be pickled, as
+            # needed for the spawn and forkserver start methods.
+            args=(dict(ROUTES), log, shard.child_pipe, shard.stats,
+                  shard.spool, sorted(wa_tokens[shard]),
+                  WORKER_METRICS.shared()))
+        process.start()
+        return process
+
+    # Workers that die or hang are restarted (see ShardedQueue).
+    RESPONSE_WORKERS_QUEUE.start(spawn)
+    return RESPONSE_WORKERS_QUEUE
+
+
+def stop_workers():
+    log.debug('Stopping workers...')
+    RESPONSE_WORKERS_QUEUE.stop()
+    ALERTS.flush()
+    log.info('Finished...')
 
 
 def builtin_httpd(address, port):
@@ -735,11 +1187,29 @@ def builtin_httpd(address, port):
     try:
         server.serve_forever()
     except (KeyboardInterrupt, SystemExit):
-        if RESPONSE_WORKER:
-            log.debug('Stopping workers...')
-            REQUEST_HANDLER.ipc.send(None)  # HAXX
-            RESPONSE_WORKER.join()
-        log.info('Finished...')
+        if RESPONSE_WORKERS_QUEUE:
+            stop_workers()
+        else:
+            log.info('Finished...')
+
+
+def run_dispatcher(path):
+    """
+    Run the single dispatcher that all front-end processes (with
+    DISPATCHER_SOCKET set) send their messages to.
+    """
+    server = DispatcherServer(
+        path, start_workers(), metrics=WORKER_METRICS.render)
+    log.info('Dispatcher listening on %s...', path)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+        stop_workers()
 
 
 # Initialize subprocess immediately. Only use this if you use the uWSGI
@@ -749,5 +1219,11 @@ if not LAZY_INITIALIZATION:
 
 
 if __name__ == '__main__':
-    # If you don't use uWSGI, you can use the builtin_httpd.
-    builtin_httpd('127.0.0.1', 8001)
+    if sys.argv[1:2] == ['dispatcher']:
+        # Start the shared dispatcher: python3 wsgi.py dispatcher
+        if not DISPATCHER_SOCKET:
+            sys.exit('Please set DISPATCHER_SOCKET in slackbridgeconf')
+        run_dispatcher(DISPATCHER_SOCKET)
+    else:
+        # If you don't use uWSGI, you can use the builtin_httpd.
+        builtin_httpd('127.0.0.1', 8001)